@@ -1,31 +1,115 @@
 import asyncio
-from functools import partial
-from bot_instance import bot, dispatcher
+import datetime
+import multiprocessing
+from bot_instance import application, create_bot, parse_args
 from handlers import router as handlers_router
-from scheduled_tasks import check_subscription_expiration_date, delete_old_server_requests
+from scheduled_tasks import archive_old_server_requests, sweep_subscriber_reachability
+from expiry import expiry_scheduler
+from database import BaseConnectionState
+from leadership import LeaderLease
+from logic import node_transport
+from placement import load_table
+from catalog import catalog
+from delivery import delivery_queue
+from qrcodes import qr_renderer
+from webhook import create_webhook_server, register_webhook, start_polling
 import logging
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from config import botconf_parser
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def main():
+def run_worker(args):
+    application.configure(args)
+    qr_renderer.start()
+    loop = asyncio.get_event_loop()
+    bot, dispatcher, scheduler = application.bot, application.dispatcher, application.scheduler
     dispatcher.include_router(handlers_router)
-    scheduler = AsyncIOScheduler()
-    subscription_checker = partial(check_subscription_expiration_date, bot=bot)
-    scheduler.add_job(subscription_checker, 'cron', hour=0, minute=0)
-    scheduler.add_job(delete_old_server_requests, CronTrigger(day_of_week='sun', hour=00, minute=00))
-    scheduler.start()
+    scheduler.add_job(archive_old_server_requests, CronTrigger(hour=3, minute=00))
+    sweep_interval = IntervalTrigger(hours=float(botconf_parser["BotParameters"]["reachability_sweep_hours"]))
+    scheduler.add_job(sweep_subscriber_reachability, sweep_interval, args=(bot,), next_run_time=datetime.datetime.now())
+    scheduler.start(paused=True)
 
-    loop = asyncio.get_event_loop()
+    leader_tasks = []
+
+    def elected():
+        scheduler.resume()
+        leader_tasks.append(loop.create_task(expiry_scheduler.run(bot)))
+        leader_tasks.append(loop.create_task(delivery_queue.recover_backlog()))
+
+    def deposed():
+        scheduler.pause()
+        while leader_tasks:
+            leader_tasks.pop().cancel()
+        expiry_scheduler.reset()
+        delivery_queue.drop_backlog()
+
+    leader_lease = LeaderLease(renew_interval=float(botconf_parser["Database"]["lease_renew_seconds"]),
+                               on_elected=elected, on_deposed=deposed)
+    lease_task = loop.create_task(leader_lease.run())
+    load_task = loop.create_task(load_table.run())
+    catalog_task = loop.create_task(catalog.run())
+    delivery_task = loop.create_task(delivery_queue.run())
+    webhook_server = None
     try:
-        loop.run_until_complete(dispatcher.start_polling(bot))
+        loop.run_until_complete(catalog.wait_loaded())
+        if args.webhook:
+            webhook_server = create_webhook_server(dispatcher, bot)
+            loop.run_until_complete(webhook_server.start())
+            loop.run_forever()
+        else:
+            loop.run_until_complete(start_polling(dispatcher, bot))
     finally:
+        if webhook_server is not None:
+            loop.run_until_complete(webhook_server.stop())
+        lease_task.cancel()
+        load_task.cancel()
+        catalog_task.cancel()
+        delivery_task.cancel()
+        loop.run_until_complete(asyncio.gather(lease_task, return_exceptions=True))
         scheduler.shutdown()
+        qr_renderer.shutdown()
+        loop.run_until_complete(node_transport.close())
+        loop.run_until_complete(BaseConnectionState.close_pool())
         loop.close()
 
+
+async def register(args):
+    bot = create_bot(args)
+    try:
+        await register_webhook(bot, handlers_router)
+    finally:
+        await bot.session.close()
+
+
+def main():
+    args = parse_args()
+    if args.workers > 1 and not args.webhook:
+        raise SystemExit("--workers needs --webhook: Telegram serves getUpdates to a single consumer")
+    if args.webhook:
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(register(args))
+        finally:
+            loop.close()
+    if args.workers == 1:
+        run_worker(args)
+        return
+    workers = [multiprocessing.Process(target=run_worker, args=(args,), name=f"bot-worker-{number}")
+               for number in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
+
 if __name__ == "__main__":
     main()
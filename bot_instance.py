@@ -1,12 +1,60 @@
-from argparse import ArgumentParser
+import asyncio
+from argparse import ArgumentParser, Namespace
+from functools import cached_property
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from config import botconf_parser, LazyObject
 
 
-parser = ArgumentParser()
-parser.add_argument("--token", help="Your bot token")
-args = parser.parse_args()
-bot = Bot(args.token, parse_mode="HTML")
-dispatcher = Dispatcher()
+def parse_args(argv=None) -> Namespace:
+    parser = ArgumentParser()
+    parser.add_argument("--token", help="Your bot token")
+    parser.add_argument("--webhook", action="store_true", help="Receive updates through the webhook in [Webhook]")
+    parser.add_argument("--workers", type=int, default=1, help="Number of bot processes sharing the webhook port")
+    return parser.parse_args(argv)
 
 
+def create_bot(args: Namespace) -> Bot:
+    session = None
+    if botconf_parser["BotHost"].get("api_server"):
+        session = AiohttpSession(api=TelegramAPIServer.from_base(botconf_parser["BotHost"]["api_server"]))
+    return Bot(args.token, session=session, parse_mode="HTML")
 
+
+class Application:
+    """Builds what a bot process runs on from botconf_parser and the command line, each part on first use.
+
+    Nothing is created on import: ``__main__`` calls ``configure`` with the
+    parsed arguments in every worker process, after the fork, and a test can
+    configure its own arguments or import handlers without any of it.
+    """
+
+    def __init__(self):
+        self.args = None
+
+    def configure(self, args: Namespace) -> "Application":
+        self.args = args
+        return self
+
+    @property
+    def workers(self) -> int:
+        return self.args.workers if self.args is not None else 1
+
+    @cached_property
+    def bot(self) -> Bot:
+        return create_bot(self.args if self.args is not None else parse_args([]))
+
+    @cached_property
+    def dispatcher(self) -> Dispatcher:
+        return Dispatcher()
+
+    @cached_property
+    def scheduler(self):
+        from apscheduler.schedulers.asyncio import AsyncIOScheduler
+        return AsyncIOScheduler(event_loop=asyncio.get_event_loop(),
+                                job_defaults={"coalesce": True, "misfire_grace_time": None})
+
+
+application = Application()
+bot = LazyObject(lambda: application.bot)
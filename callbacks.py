@@ -27,8 +27,9 @@ class UndoTransitionToTariffs(CallbackData, prefix="ut-tt"):
 
 
 class NextServerPageCallback(CallbackData, prefix="ld-n"):
-    offset: int
-    total: int
+    cursor: int
+    forward: bool
+    page: int
 
 
 class RequestAcceptedCallback(CallbackData, prefix="r-ac"):
@@ -47,8 +48,9 @@ class ShowSubscriptionsCallback(CallbackData, prefix="s-ms"):
 
 
 class NextSubscriptionPage(CallbackData, prefix="n-sp"):
-    offset: int
-    total: int
+    cursor: int
+    forward: bool
+    page: int
 
 
 class SendSubscriptionCredentialsCallback(CallbackData, prefix="ss-cc"):
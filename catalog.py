@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import asyncpg
+from config import botconf_parser
+from containers import ServerContainer, TariffContainer
+from database import UnitOfWork, connection_parameters
+from strings import YamlQueries
+
+queries = YamlQueries()
+logger = logging.getLogger(__name__)
+
+
+class Catalog:
+    """Serves the Server and Tariff tables from memory.
+
+    Triggers on both tables send a ``catalog_changed`` notification, which
+    marks the cache stale; the next read reloads it. Both tables are loaded
+    as soon as the LISTEN is in place, and ``loaded`` is set once that first
+    attempt is over, so a worker can wait for it before taking updates. The notifications are
+    received on a dedicated connection outside of the pool, because the pool
+    runs UNLISTEN when it takes a connection back. While that connection is
+    down, every read goes to the database so a missed notification can't
+    leave the cache stale. Callbacks given to ``on_change`` run on every
+    notification and whenever listening (re)starts, for caches built from
+    the same tables elsewhere. Other caches can receive their own channels
+    on the same connection through ``on_notification``.
+    """
+
+    channel = "catalog_changed"
+
+    def __init__(self):
+        self.servers = {}
+        self.tariffs = {}
+        self.stale = True
+        self.listening = False
+        self.lock = asyncio.Lock()
+        self.loaded = asyncio.Event()
+        self.listeners = []
+        self.channels = {self.channel: self.invalidate}
+
+    async def load(self):
+        self.stale = False
+        try:
+            async with UnitOfWork() as conn:
+                servers = await conn.select(queries["select_servers"])
+                tariffs = await conn.select(queries["select_tariffs"])
+        except BaseException:
+            self.stale = True
+            raise
+        self.servers = {row["id"]: ServerContainer(*row) for row in servers}
+        self.tariffs = {row["id"]: TariffContainer(*row) for row in tariffs}
+        logger.info(f"Catalog loaded: {len(self.servers)} servers, {len(self.tariffs)} tariffs")
+
+    async def fresh(self):
+        if self.stale or not self.listening:
+            async with self.lock:
+                if self.stale or not self.listening:
+                    await self.load()
+
+    async def server(self, server_id: int) -> ServerContainer:
+        await self.fresh()
+        return self.servers[server_id]
+
+    async def tariff(self, tariff_id: int) -> TariffContainer:
+        await self.fresh()
+        return self.tariffs[tariff_id]
+
+    async def all_tariffs(self) -> tuple:
+        await self.fresh()
+        return tuple(self.tariffs.values())
+
+    def on_change(self, callback):
+        self.listeners.append(callback)
+
+    def on_notification(self, channel: str, callback):
+        self.channels[channel] = callback
+
+    def changed(self):
+        self.stale = True
+        for callback in self.listeners:
+            callback()
+
+    def invalidate(self, connection, pid, channel, payload):
+        logger.info(f"{payload} has changed, the catalog will be reloaded")
+        self.changed()
+
+    async def listen(self, connection: asyncpg.Connection):
+        keepalive = float(botconf_parser["Database"]["catalog_keepalive_seconds"])
+        closed = asyncio.Event()
+        connection.add_termination_listener(lambda connection: closed.set())
+        for channel, callback in self.channels.items():
+            await connection.add_listener(channel, callback)
+        self.listening = True
+        self.changed()
+        try:
+            async with self.lock:
+                await self.load()
+        except Exception as e:
+            logger.error(f"Couldn't load the catalog: {e}")
+        self.loaded.set()
+        while not closed.is_set():
+            try:
+                await asyncio.wait_for(closed.wait(), keepalive)
+            except asyncio.TimeoutError:
+                await connection.execute("SELECT 1;")
+
+    async def wait_loaded(self):
+        try:
+            await asyncio.wait_for(self.loaded.wait(), float(botconf_parser["Database"]["catalog_startup_seconds"]))
+        except asyncio.TimeoutError:
+            logger.warning("Starting before the catalog was loaded, reads go to the database until it is")
+
+    async def run(self):
+        reconnect = float(botconf_parser["Database"]["catalog_reconnect_seconds"])
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(**connection_parameters())
+                await self.listen(connection)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                logger.error(f"Catalog notifications are unavailable: {e}")
+            finally:
+                self.listening = False
+                if connection is not None and not connection.is_closed():
+                    connection.terminate()
+            await asyncio.sleep(reconnect)
+
+
+catalog = Catalog()
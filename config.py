@@ -1,6 +1,56 @@
 import configparser
 import os
+from typing import Callable
 
-botconf_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "botconf.ini")
-botconf_parser = configparser.ConfigParser()
-botconf_parser.read(botconf_path)
\ No newline at end of file
+
+class LazyConfigParser(configparser.ConfigParser):
+    """ConfigParser that reads its file on the first lookup rather than on import."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            self.read(self.path)
+
+    def __getitem__(self, key):
+        self.load()
+        return super().__getitem__(key)
+
+    def sections(self):
+        self.load()
+        return super().sections()
+
+
+class LazyObject:
+    """Stands in for an object that ``factory`` builds the first time one of its attributes is used.
+
+    Module-level singletons are wrapped in it so that importing a module only
+    defines them; their configuration is read, and their state created, in
+    the process that ends up using them.
+    """
+
+    def __init__(self, factory: Callable):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_target", None)
+
+    def _resolve(self):
+        if self._target is None:
+            object.__setattr__(self, "_target", self._factory())
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._resolve(), name, value)
+
+    def __repr__(self):
+        return f"<lazy {self._target!r}>" if self._target is not None else "<lazy, not built yet>"
+
+
+botconf_path = os.getenv("botconf", os.path.join(os.path.dirname(os.path.realpath(__file__)), "botconf.ini"))
+botconf_parser = LazyConfigParser(botconf_path)
@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional
+from typing import Callable, Optional
 
 
 @dataclass(slots=True)
@@ -10,6 +10,7 @@ class ServerContainer:
     ip_address: str= None
     location: str = None
     flag_code: str = None
+    capacity: int = None
 
 
 @dataclass(slots=True)
@@ -42,3 +43,59 @@ class ServerSubscriber:
     server_location: str
     server_flag = None
 
+
+@dataclass(slots=True)
+class Page:
+    items: tuple
+    number: int
+    has_previous: bool
+    has_next: bool
+    first_key: int = None
+    last_key: int = None
+
+    @classmethod
+    def from_rows(cls, rows: tuple, *, size: int, number: int, forward: bool, key: Callable):
+        """Builds a keyset page from rows ordered by key and over-fetched by one
+        on the side the user is moving towards."""
+        if forward:
+            items, has_previous, has_next = rows[:size], number > 1, len(rows) > size
+        else:
+            items, has_previous, has_next = rows[-size:], len(rows) > size, True
+        if not items:
+            return cls(items, number, has_previous, False)
+        return cls(items, number, has_previous, has_next, key(items[0]), key(items[-1]))
+
+
+@dataclass(slots=True)
+class NodeReport:
+    deprovisioned: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+    node_down: bool = False
+
+    @property
+    def throughput(self) -> float:
+        return self.deprovisioned / self.elapsed if self.elapsed else 0.0
+
+
+@dataclass(slots=True)
+class NodeLoad:
+    server: ServerContainer
+    subscribers: int = 0
+    reported_clients: Optional[int] = None
+
+    @property
+    def load(self) -> int:
+        return max(self.subscribers, self.reported_clients or 0)
+
+    @property
+    def remaining(self) -> int:
+        return self.server.capacity - self.load
+
+
+@dataclass(slots=True)
+class UserSummary:
+    request_count: int
+    pending_servers: set
+    subscribed_servers: set
+    loaded_at: float = 0.0
@@ -1,6 +1,9 @@
+import hashlib
 import subprocess
+import threading
 from functools import wraps
 from flask import Flask, request, jsonify
+from werkzeug.serving import WSGIRequestHandler
 import configparser
 import os
 import json
@@ -11,6 +14,7 @@ app = Flask(__name__)
 config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "authconfig.ini")
 cfgparser = configparser.ConfigParser()
 cfgparser.read(config_path)
+xray_configuration_lock = threading.Lock()
 
 def vless_url():
     return "vless://{uuid}@{host}:{port}?security=reality&sni={SNI}&alpn={alpn}&fp=chrome&pbk={pbk}&sid={SID}&type=tcp&flow=xtls-rprx-vision&encryption=none#VLESS VPN (TG:@sweeetferrero)"
@@ -18,12 +22,12 @@ def vless_url():
 
 def parse_xray_server_credentials() -> dict:
     config = load_xray_configuration()
-    reality_settings = config["inbounds"]["streamSettings"]["realitySettings"]
+    reality_settings = config["inbounds"][0]["streamSettings"]["realitySettings"]
     output_json = {}
     output_json["SNI"] = reality_settings["dest"].split(":")[0]
     output_json["SID"] = reality_settings["shortIds"][0]
     output_json["pbk"] = cfgparser["Configuration"]["public_key"]
-    output_json["port"] = config["inbounds"]["port"]
+    output_json["port"] = config["inbounds"][0]["port"]
     output_json["alpn"] = "h2"
     return output_json
 
@@ -33,13 +37,21 @@ def load_xray_server_credentials() -> dict:
     if not os.path.exists(json_fullpath):
         credentials = parse_xray_server_credentials()
         with open(json_fullpath, 'w') as file:
-            json.dump(credentials, file, ident=4)
+            json.dump(credentials, file, indent=4)
         return credentials
 
     with open(json_fullpath, 'r') as file:
         return json.load(file)
 
 
+def credential_template() -> dict:
+    """Everything a VLESS link depends on besides the uuid, versioned so the bot can tell when its copy is stale."""
+    template = load_xray_server_credentials()
+    template["host"] = cfgparser["Configuration"]["host"]
+    template["version"] = hashlib.sha256(json.dumps(template, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return template
+
+
 def validate_request(bot_token: str, ip_address: str) -> bool:
     return (bot_token == cfgparser["ControlCentre"]["bot_token"]
             and ip_address == cfgparser["ControlCentre"]["ip_address"])
@@ -76,11 +88,15 @@ def add_user_route_handler():
     uuid = request.json.get("uuid")
     if uuid is None:
         return jsonify({"message": "No uuid specified"}), 403
-    config = load_xray_configuration()
-    config['inbounds'][0]['settings']['clients'].append({"id": uuid, "email": f'{str(request.remote_addr)}@example.com'})
-    save_xray_configuration(config)
-    restart_xray()
-    return jsonify({"message": "User added successfully"}), 200
+    with xray_configuration_lock:
+        config = load_xray_configuration()
+        config['inbounds'][0]['settings']['clients'].append({"id": uuid, "email": f'{str(request.remote_addr)}@example.com'})
+        save_xray_configuration(config)
+        restart_xray()
+    template = credential_template()
+    return jsonify({"message": "User added successfully",
+                    "link": vless_url().format(uuid=uuid, **template),
+                    "template": template}), 200
 
 
 @app.route(rule="/credentials", methods=["POST"])
@@ -89,26 +105,38 @@ def make_qr_code_route_handler():
     uuid = request.json.get("uuid")
     if uuid is None:
         return jsonify({"message": "No uuid specified"}), 403
-    credentials = load_xray_server_credentials()
-    credentials["uuid"] = uuid
-    credentials["host"] = cfgparser["Configuration"]["host"]
-    return jsonify(vless_url().format(**credentials))
+    template = credential_template()
+    return jsonify({"message": vless_url().format(uuid=uuid, **template), "template": template}), 200
+
+
+@app.route(rule="/stats", methods=["POST"])
+@authorized
+def stats_route_handler():
+    config = load_xray_configuration()
+    return jsonify({"message": {"clients": len(config['inbounds'][0]['settings']['clients']),
+                                "template_version": credential_template()["version"]}}), 200
 
 
 @app.route(rule="/delete", methods=["POST"])
 @authorized
 def delete_user_route_handler():
-    uuid = request.json.get("uuid")
-    if uuid is None:
+    uuids = request.json.get("uuids")
+    if uuids is None and request.json.get("uuid") is not None:
+        uuids = [request.json.get("uuid")]
+    if not uuids:
         return jsonify({"message": "No uuid specified"}), 403
-    config = load_xray_configuration()
-    clients = config['inbounds'][0]['settings']['clients']
-    config['inbounds'][0]['settings']['clients'] = [client for client in clients if client["uuid"] != uuid]
-    save_xray_configuration(config)
-    restart_xray()
-    return jsonify({"message": "User added successfully"}), 200
+    uuids = set(uuids)
+    with xray_configuration_lock:
+        config = load_xray_configuration()
+        clients = config['inbounds'][0]['settings']['clients']
+        config['inbounds'][0]['settings']['clients'] = [client for client in clients if client["id"] not in uuids]
+        save_xray_configuration(config)
+        restart_xray()
+    return jsonify({"message": f"{len(uuids)} users deleted successfully"}), 200
 
 
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
+    # HTTP/1.1 keeps the bot's pooled connections open between requests.
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
     app.run("127.0.0.1", 9000)
@@ -1,28 +1,160 @@
 import asyncio
+import heapq
+import itertools
 import os
-from functools import wraps, partial
-from psycopg2.extras import RealDictCursor
-from psycopg2 import pool
+import time
+from dataclasses import dataclass
+from enum import IntEnum
+from functools import partial
+import asyncpg
 import logging
+from config import botconf_parser
+from strings import YamlQueries
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def make_async(function):
-    @wraps(function)
-    async def wrapper(*args, **kwargs):
-        loop = asyncio.get_event_loop()
-        if not kwargs:
-            return await loop.run_in_executor(None, function,  *args)
-        return await loop.run_in_executor(None, partial(function, **kwargs), *args)
-    return wrapper
+class CatalogConnection(asyncpg.Connection):
+    """Connection that prepares the whole query catalog as soon as it is opened.
+
+    Statements are registered in asyncpg's per-connection statement cache under
+    their catalog names, so a later ``fetch`` of the same text skips parse/plan.
+    The pool calls ``prepare_catalog`` for every physical connection it opens,
+    which covers replacements after a reconnect.
+    """
+
+    async def prepare_catalog(self):
+        for name, query in YamlQueries().items():
+            await self._get_statement(query, None, named=f"catalog_{name}")
+
+
+async def prepare_catalog(connection: CatalogConnection):
+    await connection.prepare_catalog()
+
+
+def connection_parameters() -> dict:
+    database_config = botconf_parser["Database"]
+    return {
+        "database": database_config["name"],
+        "user": database_config["user"],
+        "password": os.getenv("password", database_config["password"]),
+        "host": database_config["host"],
+        "port": int(database_config["port"])
+    }
+
+
+async def create_pool() -> asyncpg.Pool:
+    database_config = botconf_parser["Database"]
+    return await asyncpg.create_pool(
+        connection_class=CatalogConnection,
+        init=prepare_catalog,
+        **connection_parameters(),
+        min_size=int(database_config["min_connections"]),
+        max_size=int(database_config["max_connections"])
+    )
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class PoolBusyError(Exception):
+    pass
+
+
+@dataclass(slots=True)
+class AdmissionStats:
+    admitted: int = 0
+    rejected: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    @property
+    def average_wait(self) -> float:
+        return self.total_wait / self.admitted if self.admitted else 0.0
+
+
+class AdmissionGate:
+    """Bounds connection checkouts to the pool size and queues the rest.
+
+    Waiters are served by priority and then in arrival order; a freed slot is
+    handed directly to the next waiter so late arrivals can't jump the queue.
+    """
+
+    def __init__(self, capacity: int, timeouts: dict):
+        self.capacity = capacity
+        self.timeouts = timeouts
+        self.in_use = 0
+        self.waiters = []
+        self.sequence = itertools.count()
+        self.stats = AdmissionStats()
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for *_, future in self.waiters if not future.done())
+
+    def record_wait(self, started: float):
+        waited = time.monotonic() - started
+        self.stats.admitted += 1
+        self.stats.total_wait += waited
+        self.stats.max_wait = max(self.stats.max_wait, waited)
+
+    async def acquire(self, priority: Priority = Priority.INTERACTIVE):
+        started = time.monotonic()
+        if self.in_use < self.capacity and not self.waiting:
+            self.in_use += 1
+            self.record_wait(started)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.timeouts[priority])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                self.stats.rejected += 1
+                raise PoolBusyError(f"No database connection became free in {self.timeouts[priority]}s "
+                                    f"({priority.name}, {self.waiting} waiting)") from e
+            raise
+        self.record_wait(started)
+
+    def describe(self) -> str:
+        return (f"Пул БД: занято {self.in_use}/{self.capacity}, в очереди {self.waiting}, "
+                f"выдано {self.stats.admitted}, отказов {self.stats.rejected}, ожидание в среднем "
+                f"{self.stats.average_wait * 1000:.0f} мс, максимум {self.stats.max_wait * 1000:.0f} мс")
+
+    def release(self):
+        while self.waiters:
+            *_, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_use -= 1
+
+
+def create_gate() -> AdmissionGate:
+    database_config = botconf_parser["Database"]
+    return AdmissionGate(
+        capacity=int(database_config["max_connections"]),
+        timeouts={
+            Priority.INTERACTIVE: float(database_config["acquire_timeout"]),
+            Priority.BACKGROUND: float(database_config["background_acquire_timeout"])
+        }
+    )
 
 
 class BaseConnectionState:
-    pool = pool.SimpleConnectionPool(maxconn=10, minconn=2, user="postgres", password="roottoor", database="xclient")
+    pool = None
+    gate = None
+    pool_lock = asyncio.Lock()
 
-    def __init__(self, db_name="postgres", db_user="postgres", host="127.0.0.1", port="5432", password="", use_dict_cursor=False):
+    def __init__(self, db_name="postgres", db_user="postgres", host="127.0.0.1", port="5432", password="",
+                 use_dict_cursor=False, priority=Priority.INTERACTIVE):
         self.new_state(ClosedConnectionState)
         self.host = host
         self.port = port
@@ -30,56 +162,76 @@ class BaseConnectionState:
         self.db_user = db_user
         self.db_password = password
         self.use_dict_cursor = use_dict_cursor
+        self.priority = priority
         self.logger = logging.getLogger(self.__class__.__name__)
         self.conn = None
-        self.cur = None
+        self.transaction = None
+
     def new_state(self, state):
         self.__class__ = state
 
-    def conn_open(self):
+    @classmethod
+    async def get_pool(cls) -> asyncpg.Pool:
+        async with BaseConnectionState.pool_lock:
+            if BaseConnectionState.pool is None:
+                BaseConnectionState.pool = await create_pool()
+                BaseConnectionState.gate = create_gate()
+        return BaseConnectionState.pool
+
+    @classmethod
+    async def close_pool(cls):
+        if BaseConnectionState.pool is not None:
+            await BaseConnectionState.pool.close()
+            BaseConnectionState.pool = None
+
+    async def conn_open(self):
         raise NotImplementedError
 
-    def conn_close(self):
+    async def conn_close(self):
         raise NotImplementedError
 
-    @make_async
-    def select(self, query: str):
+    async def select(self, query: str, *formats):
         raise NotImplementedError
 
-    @make_async
-    def execute(self, query: str, autocommit=True, returning=False):
+    async def execute(self, query: str, *formats, autocommit=True, returning=False):
         raise NotImplementedError
 
-    def __enter__(self):
+    async def begin(self):
+        raise NotImplementedError
+
+    async def commit(self):
+        raise NotImplementedError
+
+    async def __aenter__(self):
         raise RuntimeError("Can't use context manager with {self.__class__.__name__}".format(self=self))
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
         raise RuntimeError("Can't use context manager with {self.__class__.__name__}".format(self=self))
 
 
 class ClosedConnectionState(BaseConnectionState):
 
-    def __enter__(self) -> BaseConnectionState:
+    async def __aenter__(self) -> BaseConnectionState:
         self.logger.debug("Connection to {name} has been opened!".format(name=self.db_name))
-        self.conn_open()
+        await self.conn_open()
         return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
         self.logger.debug("Connection to {name} has been closed!".format(name=self.db_name))
-        self.conn_close()
+        await self.conn_close()
 
-    def conn_open(self):
+    async def conn_open(self):
+        pool = await self.get_pool()
+        await self.gate.acquire(self.priority)
+        try:
+            self.conn = await pool.acquire()
+        except BaseException:
+            self.gate.release()
+            raise
         self.new_state(OpenConnectionState)
-        self.conn = self.pool.getconn()
-        '''pg.connect(host=self.host, port=self.port,
-                                dbname=self.db_name, user=self.db_user, password=self.db_password)'''
-        factory = None
-        if self.use_dict_cursor:
-            factory = RealDictCursor
-        self.cur = self.conn.cursor(cursor_factory=factory)
-        self.logger.info("Cursor for {name} is opened!".format(name=self.db_name))
+        self.logger.info("Connection for {name} is acquired!".format(name=self.db_name))
 
-    def conn_close(self):
+    async def conn_close(self):
         raise RuntimeError("Already closed!")
 
 
@@ -88,38 +240,82 @@ class OpenConnectionState(BaseConnectionState):
     def __init__(self, database=None, host=None, port=None, user=None, password=""):
         super().__init__(db_name=database, host=host, port=port, db_user=user, password=password)
 
-    def conn_open(self):
+    async def conn_open(self):
         raise RuntimeError("Already open!")
 
-    def conn_close(self):
-        self.logger.debug("Cursor for {name} is closed!".format(name=self.db_name))
-        self.pool.putconn(self.conn)
-        # self.conn.close()
-        self.conn, self.cur = None, None
-        self.new_state(ClosedConnectionState)
+    async def conn_close(self):
+        self.logger.debug("Connection for {name} is released!".format(name=self.db_name))
+        try:
+            if self.transaction is not None:
+                await self.transaction.rollback()
+        finally:
+            try:
+                await self.pool.release(self.conn)
+            finally:
+                self.gate.release()
+            self.conn, self.transaction = None, None
+            self.new_state(ClosedConnectionState)
 
-    @make_async
-    def select(self, query: str, *formats):
+    async def select(self, query: str, *formats):
         logger.warning(formats)
-        self.cur.execute(query, formats)
+        result = await self.conn.fetch(query, *formats)
         self.logger.info(f"{query} executed.")
-        result = self.cur.fetchall()
-        self.logger.info(f"Query result: {result}")
+        self.logger.debug(f"Query returned {len(result)} rows.")
+        if self.use_dict_cursor:
+            return [dict(record) for record in result]
         return result
 
-    @make_async
-    def execute(self, query: str, *formats, autocommit=False, returning=False):
-        self.cur.execute(query, formats)
-        self.logger.info(f"{query} executed.")
+    async def begin(self):
+        if self.transaction is None:
+            self.transaction = self.conn.transaction()
+            await self.transaction.start()
+
+    async def commit(self):
+        if self.transaction is not None:
+            await self.transaction.commit()
+            self.transaction = None
+
+    async def execute(self, query: str, *formats, autocommit=False, returning=False):
+        await self.begin()
         ret = None
         if returning:
-            ret = self.cur.fetchall()
+            ret = await self.conn.fetch(query, *formats)
+        else:
+            await self.conn.execute(query, *formats)
+        self.logger.info(f"{query} executed.")
         if autocommit:
-            self.conn.commit()
+            await self.commit()
             self.logger.info(f"{query} commited.")
         return ret
 
 
-Database = partial(BaseConnectionState, password=os.getenv("password"))
+class UnitOfWork:
+    """Runs the statements of one logical operation in a single transaction.
 
+    The connection is checked out on enter and returned on exit, so node calls,
+    QR rendering and Telegram requests belong outside of the block. The
+    transaction is committed if the block succeeds and rolled back otherwise.
+    """
 
+    def __init__(self, priority=Priority.INTERACTIVE, use_dict_cursor=False):
+        self.state = BaseConnectionState(db_name=botconf_parser["Database"]["name"],
+                                         use_dict_cursor=use_dict_cursor, priority=priority)
+
+    async def __aenter__(self) -> BaseConnectionState:
+        await self.state.conn_open()
+        try:
+            await self.state.begin()
+        except BaseException:
+            await self.state.conn_close()
+            raise
+        return self.state
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                await self.state.commit()
+        finally:
+            await self.state.conn_close()
+
+
+Database = partial(BaseConnectionState, password=os.getenv("password"))
@@ -0,0 +1,271 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional
+from aiogram.exceptions import (TelegramAPIError, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter,
+                                TelegramServerError)
+from bot_instance import application, bot
+from config import botconf_parser, LazyObject
+from database import UnitOfWork, Priority
+from strings import YamlQueries
+
+queries = YamlQueries()
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        self.refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self.refill(now)
+        self.tokens -= 1
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = 0
+
+    @property
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self.refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+@dataclass(slots=True)
+class Delivery:
+    chat_id: int
+    method: Callable
+    kwargs: dict
+    priority: Priority
+    future: Optional[asyncio.Future] = None
+    backlog_id: Optional[int] = None
+    attempts: int = 0
+
+
+class DeliveryQueue:
+    """Paces every outgoing Bot API call against Telegram's global and per-chat limits.
+
+    Deliveries wait in one lane per priority, so interactive replies always go
+    out before bulk notices. A delivery whose chat has no token left, or which
+    Telegram answered with retry_after, is set aside until it may be sent and
+    doesn't hold up the other chats. Bulk notices are stored in OutboundMessage
+    before they are queued and deleted once Telegram has taken them, so a
+    restart resends whatever was still waiting. Notices for chats known to be
+    unreachable (from the reachability sweep or a 403) are dropped.
+
+    With ``--workers N`` every process has its own queue, so each gets 1/N of
+    delivery_global_rate, and bulk notices are only queued by the leader.
+    Per-chat buckets stay per process: a chat's interactive replies are
+    answered by whichever worker got its update, and the retry_after handling
+    covers the rare burst that spans two workers.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, workers: int, max_attempts: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chats = {}
+        self.prune_at = 10000
+        self.lanes = {priority: deque() for priority in Priority}
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.ready = asyncio.Event()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.queued_backlog = set()
+        self.unreachable = set()
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chats:
+            if len(self.chats) >= self.prune_at:
+                self.chats = {key: bucket for key, bucket in self.chats.items() if not bucket.idle}
+                # Pruning again only once the table has doubled keeps the cost per new chat constant
+                # even when most chats are still active.
+                self.prune_at = max(10000, 2 * len(self.chats))
+            self.chats[chat_id] = TokenBucket(self.chat_rate, 1)
+        return self.chats[chat_id]
+
+    def set_reachable(self, chat_id: int, reachable: bool):
+        if reachable:
+            self.unreachable.discard(chat_id)
+        else:
+            self.unreachable.add(chat_id)
+
+    def put(self, delivery: Delivery):
+        self.lanes[delivery.priority].append(delivery)
+        self.ready.set()
+
+    def defer(self, delivery: Delivery, until: float):
+        heapq.heappush(self.delayed, (until, next(self.sequence), delivery))
+        self.ready.set()
+
+    async def submit(self, method: Callable, chat_id: int, priority=Priority.INTERACTIVE, **kwargs):
+        """Queues a Bot API call and returns its result once it has been sent."""
+        future = asyncio.get_running_loop().create_future()
+        self.put(Delivery(chat_id=chat_id, method=method, kwargs={"chat_id": chat_id, **kwargs},
+                          priority=priority, future=future))
+        return await future
+
+    def queue_backlog(self, rows):
+        for row in rows:
+            if row["id"] in self.queued_backlog:
+                continue
+            self.queued_backlog.add(row["id"])
+            self.put(Delivery(chat_id=row["chat_id"], method=bot.send_message,
+                              kwargs={"chat_id": row["chat_id"], "text": row["text"]},
+                              priority=Priority.BACKGROUND, backlog_id=row["id"]))
+
+    async def enqueue_notices(self, notices: list):
+        """Stores (chat_id, text) notices in the backlog and queues them behind interactive replies."""
+        notices = [(chat_id, text) for chat_id, text in notices if chat_id not in self.unreachable]
+        if not notices:
+            return
+        chat_ids, texts = zip(*notices)
+        async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+            rows = await conn.execute(queries["insert_outbound_messages"], list(chat_ids), list(texts),
+                                      returning=True)
+        self.queue_backlog(rows)
+
+    async def recover(self):
+        async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+            rows = await conn.select(queries["select_outbound_messages"])
+        self.queue_backlog(rows)
+        logger.info(f"Recovered {len(rows)} undelivered messages")
+
+    def drop_backlog(self):
+        """Forgets the queued backlog rows so that only the next leader, which recovers them, sends them."""
+        for priority, lane in self.lanes.items():
+            self.lanes[priority] = deque(delivery for delivery in lane if delivery.backlog_id is None)
+        self.delayed = [entry for entry in self.delayed if entry[-1].backlog_id is None]
+        heapq.heapify(self.delayed)
+        self.queued_backlog.clear()
+
+    async def next_delivery(self) -> Delivery:
+        while True:
+            now = time.monotonic()
+            due = []
+            while self.delayed and self.delayed[0][0] <= now:
+                due.append(heapq.heappop(self.delayed)[-1])
+            for delivery in reversed(due):
+                self.lanes[delivery.priority].appendleft(delivery)
+            for lane in self.lanes.values():
+                while lane:
+                    delivery = lane.popleft()
+                    chat_bucket = self.chat_bucket(delivery.chat_id)
+                    wait = chat_bucket.delay(now)
+                    if wait > 0:
+                        self.defer(delivery, now + wait)
+                        continue
+                    chat_bucket.take(now)
+                    return delivery
+            self.ready.clear()
+            timeout = self.delayed[0][0] - now if self.delayed else None
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def mark_reachable(self, chat_id: int):
+        """Clears a chat that was marked unreachable but took a message, e.g. after the user unblocked the bot,
+        in memory and in Subscriber, so the next sweep doesn't mark it again from the stored flag."""
+        self.set_reachable(chat_id, True)
+        try:
+            async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+                await conn.execute(queries["update_subscriber_reachability"], [chat_id], [True])
+        except Exception as e:
+            logger.error(f"Couldn't store that {chat_id} is reachable again: {e}")
+
+    async def forget(self, delivery: Delivery):
+        if delivery.backlog_id is None:
+            return
+        self.queued_backlog.discard(delivery.backlog_id)
+        try:
+            async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+                await conn.execute(queries["delete_outbound_message"], delivery.backlog_id)
+        except Exception as e:
+            logger.error(f"Couldn't remove message {delivery.backlog_id} from the backlog: {e}")
+
+    async def deliver(self, delivery: Delivery):
+        if delivery.backlog_id is not None and delivery.backlog_id not in self.queued_backlog:
+            return
+        if delivery.backlog_id is not None and delivery.chat_id in self.unreachable:
+            await self.forget(delivery)
+            return
+        try:
+            result = await delivery.method(**delivery.kwargs)
+        except TelegramRetryAfter as e:
+            until = time.monotonic() + e.retry_after
+            logger.warning(f"Flood control for {delivery.chat_id}, retrying in {e.retry_after}s")
+            self.chat_bucket(delivery.chat_id).block(until)
+            self.global_bucket.block(until)
+            self.defer(delivery, until)
+            return
+        except (TelegramNetworkError, TelegramServerError) as e:
+            delivery.attempts += 1
+            if delivery.attempts < self.max_attempts:
+                self.defer(delivery, time.monotonic() + 2 ** delivery.attempts)
+                return
+            result = e
+        except TelegramForbiddenError as e:
+            self.unreachable.add(delivery.chat_id)
+            result = e
+        except TelegramAPIError as e:
+            result = e
+        except Exception as e:
+            logger.error(f"Unexpected error while sending to {delivery.chat_id}: {e}")
+            result = e
+        else:
+            if delivery.chat_id in self.unreachable:
+                await self.mark_reachable(delivery.chat_id)
+        if delivery.future is None:
+            if isinstance(result, Exception):
+                logger.error(f"Failed to send message to {delivery.chat_id}: {result}")
+        elif not delivery.future.done():
+            if isinstance(result, Exception):
+                delivery.future.set_exception(result)
+            else:
+                delivery.future.set_result(result)
+        await self.forget(delivery)
+
+    async def worker(self):
+        while True:
+            delivery = await self.next_delivery()
+            while (wait := self.global_bucket.delay(time.monotonic())) > 0:
+                await asyncio.sleep(wait)
+            self.global_bucket.take(time.monotonic())
+            await self.deliver(delivery)
+
+    async def recover_backlog(self):
+        try:
+            await self.recover()
+        except Exception as e:
+            logger.error(f"Couldn't recover the delivery backlog: {e}")
+
+    async def run(self):
+        await asyncio.gather(*(self.worker() for _ in range(self.workers)))
+
+
+delivery_queue = LazyObject(lambda: DeliveryQueue(
+    global_rate=float(botconf_parser["BotParameters"]["delivery_global_rate"]) / application.workers,
+    chat_rate=float(botconf_parser["BotParameters"]["delivery_chat_rate"]),
+    workers=int(botconf_parser["BotParameters"]["delivery_workers"]),
+    max_attempts=int(botconf_parser["BotParameters"]["delivery_max_attempts"])))
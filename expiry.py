@@ -0,0 +1,95 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+from aiogram import Bot
+from config import botconf_parser
+from database import UnitOfWork, Priority
+from scheduled_tasks import check_subscription_expiration_date
+from strings import YamlQueries
+
+queries = YamlQueries()
+logger = logging.getLogger(__name__)
+
+
+class ExpiryScheduler:
+    """Expires subscriptions as their deadlines pass instead of once a day.
+
+    Deadlines up to ``expiry_horizon_hours`` ahead are kept in a min-heap that
+    is reloaded when the horizon is reached and topped up by ``push`` whenever
+    a subscription is inserted. When the earliest deadline is due, one expiry
+    pass runs and deprovisions everything that is due by then; the heap only
+    decides *when* to run, ServerSubscriber stays the source of truth.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()
+        self.horizon = None
+        self.wakeup = asyncio.Event()
+
+    def push(self, deadline: datetime.datetime, uuid: str = None):
+        if self.horizon is None or deadline >= self.horizon:
+            return
+        earliest = self.heap[0][0] if self.heap else None
+        heapq.heappush(self.heap, (deadline, next(self.sequence), uuid))
+        if earliest is None or deadline < earliest:
+            self.wakeup.set()
+
+    def reset(self):
+        """Forgets the loaded deadlines; the next run starts with a refresh."""
+        self.heap = []
+        self.horizon = None
+
+    async def refresh(self):
+        horizon = datetime.datetime.now() + datetime.timedelta(
+            hours=float(botconf_parser["BotParameters"]["expiry_horizon_hours"]))
+        async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+            deadlines = await conn.select(queries["select_upcoming_expirations"], horizon)
+        self.heap = [(deadline, next(self.sequence), uuid) for deadline, uuid in deadlines]
+        heapq.heapify(self.heap)
+        self.horizon = horizon
+        logger.info(f"Loaded {len(self.heap)} deadlines up to {horizon:%d.%m.%Y, %H:%M}")
+
+    def pop_due(self, now: datetime.datetime) -> int:
+        due = 0
+        while self.heap and self.heap[0][0] <= now:
+            heapq.heappop(self.heap)
+            due += 1
+        return due
+
+    async def expire_due(self, bot: Bot, now: datetime.datetime):
+        retry_after = datetime.timedelta(seconds=float(botconf_parser["BotParameters"]["expiry_retry_seconds"]))
+        try:
+            reports = await check_subscription_expiration_date(bot, now)
+        except Exception as e:
+            logger.error(f"Expiry pass failed: {e}")
+            self.push(datetime.datetime.now() + retry_after)
+            return
+        if any(report.failed for report in reports.values()):
+            self.push(datetime.datetime.now() + retry_after)
+
+    async def run(self, bot: Bot):
+        while True:
+            now = datetime.datetime.now()
+            if self.horizon is None or now >= self.horizon:
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    logger.error(f"Couldn't load expiry deadlines: {e}")
+                    self.horizon = None
+                    await asyncio.sleep(float(botconf_parser["BotParameters"]["expiry_retry_seconds"]))
+                    continue
+            if self.pop_due(now):
+                await self.expire_due(bot, now)
+                continue
+            next_wakeup = min(self.heap[0][0], self.horizon) if self.heap else self.horizon
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), (next_wakeup - now).total_seconds())
+            except asyncio.TimeoutError:
+                pass
+
+
+expiry_scheduler = ExpiryScheduler()
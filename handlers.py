@@ -3,18 +3,25 @@ import logging
 import uuid
 import aiogram.exceptions
 from aiogram.exceptions import TelegramAPIError
-from containers import ServerContainer, TariffContainer, ServerRequest, ServerSubscriber
+from containers import ServerContainer, ServerRequest, ServerSubscriber, Page
 from aiogram import Router, Bot
 from aiogram.filters import Command, StateFilter
-from aiogram.types import Message, CallbackQuery, BufferedInputFile
+from aiogram.types import Message, CallbackQuery
 from keyboards import *
-from database import BaseConnectionState
-from logic import XrayUpdateRequest, make_qr_code, send_message_to_user
+from catalog import catalog
+from database import UnitOfWork, BaseConnectionState
+from expiry import expiry_scheduler
+from logic import XrayUpdateRequest, XrayBatchDeleteRequest, send_message_to_user, node_transport, credential_cache
+from placement import load_table
+from qrcodes import qr_codes
+from summaries import user_summaries
 from strings import YamlStrings, YamlQueries
 from dateutil.relativedelta import relativedelta
 from config import botconf_parser
 
 server_flags = {"France": "🇫🇷", "Netherlands": "🇳🇱", "Finland": "🇫🇮"}
+max_pending_requests = 2
+requester_lock_id = 7_310_003
 
 logger = logging.getLogger(__name__)
 router = Router(name=__name__)
@@ -32,12 +39,18 @@ async def start_command_handler(message: Message):
 
 
 @router.callback_query(ShowSubscriptionsCallback.filter())
-async def show_user_subscriptions_handler(callback: CallbackQuery):
-    with BaseConnectionState(db_name="xclient") as conn:
-        subscriptions_count = (await conn.select(queries["select_total_subscriptions"], callback.from_user.id))[0][0]
-        subscriptions = map(lambda cont: ServerSubscriber(*cont),
-            await conn.select(queries["select_active_subscriptions"], callback.from_user.id,
-                              botconf_parser["BotParameters"]["subscriptions_page_size"],  0))
+@router.callback_query(NextSubscriptionPage.filter())
+async def show_user_subscriptions_handler(callback: CallbackQuery, callback_data: CallbackData):
+    page_size = int(botconf_parser["BotParameters"]["subscriptions_page_size"])
+    cursor, forward, page_number = 0, True, 1
+    if isinstance(callback_data, NextSubscriptionPage):
+        cursor, forward, page_number = callback_data.cursor, callback_data.forward, callback_data.page
+    query = queries["select_active_subscriptions" if forward else "select_active_subscriptions_before"]
+    async with UnitOfWork() as conn:
+        subscriptions = tuple(map(lambda cont: ServerSubscriber(*cont),
+                                  await conn.select(query, callback.from_user.id, cursor, page_size + 1)))
+    page = Page.from_rows(subscriptions, size=page_size, number=page_number, forward=forward,
+                          key=lambda subscription: subscription.server_id)
 
     user_subscriptions = tuple(map(lambda subscription: (strings["subscriptions_list"].format(
             uuid=subscription.uuid,
@@ -45,40 +58,13 @@ async def show_user_subscriptions_handler(callback: CallbackQuery):
             alias="".join(["<i>", subscription.server_alias, "</i>"]),
             country=subscription.server_location), subscription.uuid,
             f"{subscription.server_location}{server_flags[subscription.server_location]} | {subscription.server_alias}"),
-                                   subscriptions))
+                                   page.items))
 
     if not user_subscriptions:
         await callback.message.edit_text(text="Подписки не найдены", reply_markup=BackToMainMenuKeyboard().markup())
         return
 
-    markup = SubscriptionsPaginationKeyboard(button_text_iterator=user_subscriptions,
-                                             offset=0, offset_change=int(botconf_parser["BotParameters"]["subscriptions_page_size"]),
-                                             total=subscriptions_count).markup()
-    await callback.message.edit_text(text="".join(map(lambda x: f'{x[0]}\n\n', user_subscriptions)), reply_markup=markup)
-
-
-@router.callback_query(NextSubscriptionPage.filter())
-async def next_subscription_page_handler(callback: CallbackQuery, callback_data: CallbackData):
-    offset, pages_count = callback_data.offset, callback_data.total
-    with BaseConnectionState(db_name="xclient") as conn:
-        subscriptions = map(lambda cont: ServerSubscriber(*cont),
-                            await conn.select(queries["select_active_subscriptions"], callback.from_user.id,
-                                              botconf_parser["BotParameters"]["subscriptions_page_size"], offset))
-
-    user_subscriptions = tuple(map(lambda subscription: (strings["subscriptions_list"].format(
-        uuid=subscription.uuid,
-        valid_until=subscription.subscription_valid_until.strftime("%d.%m.%Y, %H:%M"),
-        alias="".join(["<i>", subscription.server_alias, "</i>"]),
-        country=subscription.server_location), subscription.uuid,
-    f"{subscription.server_location}{server_flags[subscription.server_location]} | {subscription.server_alias}"), subscriptions))
-
-    if not user_subscriptions:
-        await callback.message.edit_text(text="Подписки не найдены", reply_markup=BackToMainMenuKeyboard().markup())
-        return
-    markup = SubscriptionsPaginationKeyboard(button_text_iterator=user_subscriptions,
-                                             offset=offset, offset_change=int(
-            botconf_parser["BotParameters"]["subscriptions_page_size"]),
-                                             total=pages_count).markup()
+    markup = SubscriptionsPaginationKeyboard(button_text_iterator=user_subscriptions, page=page).markup()
     await callback.message.edit_text(text="".join(map(lambda x: f'{x[0]}\n\n', user_subscriptions)), reply_markup=markup)
 
 
@@ -92,75 +78,87 @@ async def back_to_main_meny_handler(callback: CallbackQuery):
     await callback.message.edit_text(text=strings["greetings"], reply_markup=StartInlineKeyboard().markup())
 
 
+def from_bot_host(message: Message) -> bool:
+    return message.from_user.id == int(botconf_parser["BotHost"]["id"])
+
+
+@router.message(Command("load"), from_bot_host)
+async def load_command_handler(message: Message):
+    await load_table.refresh()
+    lines = [load_table.describe()]
+    if BaseConnectionState.gate is not None:
+        lines.append(BaseConnectionState.gate.describe())
+    await message.answer("\n\n".join(lines))
+
+
 @router.callback_query(UndoTransitionToTariffs.filter())
 @router.callback_query(CreateConnectionCallback.filter())
 async def create_connection_handler(callback: CallbackQuery, callback_data: CallbackData):
-    with BaseConnectionState(db_name="xclient") as conn:
-        if isinstance(callback_data, CreateConnectionCallback):
-            requests_count = await conn.select(queries["select_total_requests_made_by_client"], callback.from_user.id)
-            if requests_count[0][0] > 1:
-                await callback.message.answer(
-                    text=f"😔 Вы не можете отправлять более чем 2 запроса на покупку до одобрения администратором.",
-                    reply_markup=BackToMainMenuKeyboard().markup())
-                return
-        servers_count = (await conn.select(queries["select_server_count"]))[0][0]
-        logger.warning(int(botconf_parser["BotParameters"]["page_size"]))
-        servers = map(lambda cont: ServerContainer(*cont),
-                      await conn.select(queries["select_servers_with_offset"], int(botconf_parser["BotParameters"]["page_size"]), 0))
-
-    markup = ServerChoiceKeyboard(servers, servers_count).markup()
+    if isinstance(callback_data, CreateConnectionCallback):
+        summary = await user_summaries.get(callback.from_user.id)
+        if summary.request_count >= max_pending_requests:
+            await callback.message.answer(
+                text=f"😔 Вы не можете отправлять более чем {max_pending_requests} запроса на покупку до одобрения администратором.",
+                reply_markup=BackToMainMenuKeyboard().markup())
+            return
+    await load_table.ensure_loaded()
+    page = load_table.page(size=int(botconf_parser["BotParameters"]["page_size"]))
+    markup = ServerChoiceKeyboard(page, unavailable=node_transport.unavailable_nodes()).markup()
     await callback.message.edit_text(strings["server_choice"], reply_markup=markup)
 
 
 @router.callback_query(NextServerPageCallback.filter())
 async def load_next_server_page(callback: CallbackQuery, callback_data: CallbackData):
-    offset, servers_count = callback_data.offset, callback_data.total
-    with BaseConnectionState(db_name="xclient") as conn:
-        servers = map(lambda cont: ServerContainer(*cont),
-                      await conn.select(queries["select_servers_with_offset"], int(botconf_parser["BotParameters"]["page_size"]), offset))
-    markup = ServerChoiceKeyboard(servers, servers_count, offset=offset).markup()
+    await load_table.ensure_loaded()
+    page = load_table.page(size=int(botconf_parser["BotParameters"]["page_size"]), cursor=callback_data.cursor,
+                           forward=callback_data.forward, number=callback_data.page)
+    markup = ServerChoiceKeyboard(page, unavailable=node_transport.unavailable_nodes()).markup()
     await callback.message.edit_reply_markup(reply_markup=markup)
 
 
+def request_refusal(summary, server_id: int):
+    if server_id in summary.pending_servers:
+        return "Вы уже сделали запрос на этот сервер. Дождитесь ответа администрации."
+    if server_id in summary.subscribed_servers:
+        return "📦 Вы уже приобрели подписку на данный сервер!"
+    if summary.request_count >= max_pending_requests:
+        return f"😔 Вы не можете отправлять более чем {max_pending_requests} запроса на покупку до одобрения администратором."
+    return None
+
+
 @router.callback_query(ChooseParticularServerCallback.filter())
 async def choose_server_handler(callback: CallbackQuery, callback_data: CallbackData):
-    with (BaseConnectionState(db_name="xclient") as conn):
-        already_made_request = await conn.select(queries["already_made_request"], callback.from_user.id, callback_data.server_id)
-        if already_made_request:
-            await callback.message.edit_text("Вы уже сделали запрос на этот сервер. Дождитесь ответа администрации.",
-                                          reply_markup=BackToMainMenuKeyboard().markup())
-            return
-        already_have_subscription = await conn.select(
-            queries["check_if_user_has_subscription"], callback.from_user.id, callback_data.server_id)
-        if already_have_subscription:
-            await callback.message.edit_text("📦 Вы уже приобрели подписку на данный сервер!",
-                                          reply_markup=BackToMainMenuKeyboard().markup())
-            return
-        tariffs = map(lambda cont: TariffContainer(*cont), await conn.select(queries["select_tariffs"]))
-    markup = SubscriptionDurationKeyboard(server_data=callback_data, tariffs=tariffs).markup()
+    summary = await user_summaries.get(callback.from_user.id)
+    refusal = request_refusal(summary, callback_data.server_id)
+    if refusal is not None:
+        await callback.message.edit_text(refusal, reply_markup=BackToMainMenuKeyboard().markup())
+        return
+    markup = SubscriptionDurationKeyboard(server_data=callback_data, tariffs=await catalog.all_tariffs()).markup()
     await callback.message.edit_text(text="💰 Выберите тарифный план: ", reply_markup=markup)
 
 
 @router.callback_query(ChooseServerTariffCallback.filter())
 async def choose_tariff_handler(callback: CallbackQuery, callback_data: CallbackData, bot: Bot):
     uid = uuid.uuid4()
+    server = await catalog.server(callback_data.server_id)
+    tariff = await catalog.tariff(callback_data.tariff_id)
+    # The summary checked in the earlier steps may be stale in another worker, so the limits are checked again
+    # under a per-user lock while inserting.
+    async with UnitOfWork() as conn:
+        await conn.select(queries["lock_requester"], requester_lock_id, callback.from_user.id)
+        inserted = await conn.execute(queries["insert_server_request"], str(uid), callback.from_user.id,
+                                      callback.from_user.username, callback_data.server_id, callback_data.tariff_id,
+                                      max_pending_requests, returning=True)
+    if not inserted:
+        summary = await user_summaries.load(callback.from_user.id)
+        refusal = request_refusal(summary, callback_data.server_id) or strings["unexpected_error_message"]
+        await callback.message.edit_text(refusal, reply_markup=BackToMainMenuKeyboard().markup())
+        return
+    user_summaries.request_added(callback.from_user.id, callback_data.server_id)
     await callback.message.edit_text(
         text=strings["pay_for_subscription"].format(uid=uid,
                                                     today=datetime.datetime.today().strftime("%d.%m.%Y, %H:%M")),
                                      reply_markup=BackToMainMenuKeyboard().markup())
-    with BaseConnectionState(db_name="xclient") as conn:
-        server = next(map(lambda cont: ServerContainer(*cont),
-                          await conn.select(queries["select_specific_server"], callback_data.server_id)))
-        tariff = next(map(lambda cont: TariffContainer(*cont),
-                          await conn.select(queries["select_specific_tariff"], callback_data.tariff_id)))
-        await conn.execute(
-            queries["insert_server_request"].format(
-                uid=uid,
-                user_id=callback.from_user.id,
-                username="NULL" if callback.from_user.username is None else callback.from_user.username,
-                server_id=callback_data.server_id,
-                tariff_id=callback_data.tariff_id
-                ), autocommit=True)
 
     await send_message_to_user(bot,
                             chat_id=int(botconf_parser["BotHost"]["id"]),
@@ -177,74 +175,103 @@ async def choose_tariff_handler(callback: CallbackQuery, callback_data: Callback
 
 @router.callback_query(RequestAcceptedCallback.filter())
 async def request_accepted_handler(callback: CallbackQuery, callback_data: CallbackData, bot: Bot):
-    with BaseConnectionState(db_name="xclient") as conn:
+    async with UnitOfWork() as conn:
         request = tuple(
             map(lambda cont:
                 ServerRequest(*cont), await conn.select(queries["select_server_request"], callback_data.uid)))
 
-        if not request:
-            await bot.send_message(chat_id=botconf_parser["BotHost"]["id"],
+    if not request:
+        await send_message_to_user(bot, chat_id=botconf_parser["BotHost"]["id"],
                                    text="❌ Запрос не найден в базе данных. Возможно, он уже был удален планировщиком.")
-            await callback.message.delete()
-            return
+        await callback.message.delete()
+        return
 
-        request = request[0]
+    request = request[0]
+    add_request_result = vless_link = None
+    if node_transport.is_available(callback_data.server_ip):
         vless_update_request = XrayUpdateRequest(uuid=callback_data.uid,
                                                  server_ip=callback_data.server_ip, user_id=request.telegram_requester_id)
         add_request_result = await vless_update_request.make_request_to_server(method="add")
-        credentials_request_result = await vless_update_request.make_request_to_server(method="credentials")
-        if add_request_result is None or credentials_request_result is None:
-            logger.error(f"Couldn't reach {callback_data.server_ip}. Check if the server is up")
-            await callback.message.edit_text(text=f"Warning: Сервер недоступен в "
-                                                  f"{datetime.datetime.now().strftime('%d.%m.%Y, %H:%M:%S')}!\n{callback.message.text}",
-                                             reply_markup=callback.message.reply_markup)
-            return
-
-        vless_link = credentials_request_result["message"]
-        image_bytes = make_qr_code(vless_link)
-        await conn.execute(queries["delete_server_request"], callback_data.uid, autocommit=True)
-
-        try:
-            await bot.send_photo(chat_id=request.telegram_requester_id,
-                                 photo=BufferedInputFile(file=image_bytes.getbuffer(),
-                                                         filename="vless_link.png"),
-                                 caption=strings["purchase_completed_message"])
-        except TelegramAPIError as e:
-            logger.error(f"Failed to send message to {request.telegram_requester_id}: {e}")
-            await send_message_to_user(bot, chat_id=request.telegram_requester_id, text=strings["unexpected_error_message"])
-            return
+        if add_request_result is not None:
+            credential_cache.store(callback_data.server_ip, add_request_result.get("template"))
+            vless_link = add_request_result.get("link") or await credential_cache.get_link(
+                callback_data.server_ip, callback_data.uid, request.telegram_requester_id)
+    if add_request_result is None or vless_link is None:
+        logger.error(f"Couldn't reach {callback_data.server_ip}. Check if the server is up")
+        await callback.message.edit_text(text=f"Warning: Сервер недоступен в "
+                                              f"{datetime.datetime.now().strftime('%d.%m.%Y, %H:%M:%S')}!\n{callback.message.text}",
+                                         reply_markup=callback.message.reply_markup)
+        return
 
-        await send_message_to_user(bot,
-            chat_id=request.telegram_requester_id,
-            text="📘 Полезные ссылки:",
-            reply_markup=HelpInlineKeyboard(strings["nekobox_url"]).markup()
-        )
-        # await bot.send_message(chat_id=request.telegram_requester_id, text=vless_link)
+    async with UnitOfWork() as conn:
+        deleted_request = await conn.execute(queries["delete_server_request"], callback_data.uid, returning=True)
+        if deleted_request:
+            valid_until = datetime.datetime.now() + relativedelta(months=+int(callback_data.duration))
+            await conn.execute(queries["insert_subscriber"], request.telegram_requester_id,
+                               request.telegram_requester_username)
+            await conn.execute(queries["insert_subscription"],
+                               request.requested_server, request.telegram_requester_id,
+                               request.requested_tariff, callback_data.uid, valid_until)
+            subscribed = True
+        else:
+            subscribed = bool(await conn.select(queries["select_subscription_server"],
+                                                request.telegram_requester_id, callback_data.uid))
+
+    if not deleted_request and not subscribed:
+        # The request was rejected or archived while the node was adding the client: nothing would ever
+        # expire it, so it is taken off the node again. A second tap on an accepted request keeps the client.
+        delete_response = await XrayBatchDeleteRequest(uuids=[callback_data.uid],
+                                                       server_ip=callback_data.server_ip).make_request_to_server(
+            method="delete")
+        if delete_response is None:
+            logger.error(f"Couldn't remove {callback_data.uid} from {callback_data.server_ip}, it has no subscription")
+
+    if deleted_request:
+        expiry_scheduler.push(valid_until, callback_data.uid)
+        load_table.add_subscription(request.requested_server)
+        user_summaries.request_removed(request.telegram_requester_id, request.requested_server)
+        user_summaries.subscription_added(request.telegram_requester_id, request.requested_server)
+
+    if not deleted_request:
+        await send_message_to_user(bot, chat_id=botconf_parser["BotHost"]["id"],
+                                   text="❌ Запрос не найден в базе данных. Возможно, он уже был удален планировщиком.")
         await callback.message.delete()
-        await conn.execute(queries["insert_subscriber"], request.telegram_requester_id,
-                           request.telegram_requester_username, autocommit=True)
-        await conn.execute(queries["insert_subscription"],
-                           request.requested_server, request.telegram_requester_id,
-                           request.requested_tariff, callback_data.uid,
-                           datetime.datetime.now() + relativedelta(months=+int(callback_data.duration)), autocommit=True)
+        return
+
+    try:
+        await qr_codes.send_photo(bot, chat_id=request.telegram_requester_id, link=vless_link,
+                                  caption=strings["purchase_completed_message"])
+    except TelegramAPIError as e:
+        logger.error(f"Failed to send message to {request.telegram_requester_id}: {e}")
+        await send_message_to_user(bot, chat_id=request.telegram_requester_id, text=strings["unexpected_error_message"])
+        return
+
+    await send_message_to_user(bot,
+        chat_id=request.telegram_requester_id,
+        text="📘 Полезные ссылки:",
+        reply_markup=HelpInlineKeyboard(strings["nekobox_url"]).markup()
+    )
+    # await bot.send_message(chat_id=request.telegram_requester_id, text=vless_link)
+    await callback.message.delete()
 
 
 @router.callback_query(RequestRejectedCallback.filter())
 async def request_rejected_handler(callback: CallbackQuery, callback_data: CallbackData, bot: Bot):
-    with BaseConnectionState(db_name="xclient") as conn:
+    async with UnitOfWork() as conn:
         query_result = tuple(
             map(lambda cont:
                 ServerRequest(*cont), await conn.execute(queries["delete_server_request"], callback_data.uid,
-                                          autocommit=True, returning=True)))
+                                          returning=True)))
 
-        if not query_result:
-            await bot.send_message(chat_id=botconf_parser["BotHost"]["id"],
+    if not query_result:
+        await send_message_to_user(bot, chat_id=botconf_parser["BotHost"]["id"],
                                    text="❌ Запрос не найден в базе данных. Возможно, он уже был удален планировщиком.")
-            await callback.message.delete()
-            return
+        await callback.message.delete()
+        return
 
-        query_result = query_result[0]
-        user_id = query_result.telegram_requester_id
+    query_result = query_result[0]
+    user_id = query_result.telegram_requester_id
+    user_summaries.request_removed(user_id, query_result.requested_server)
     await send_message_to_user(
        bot,
        chat_id=user_id, text=strings["rejected_user_message"].format(uid=callback_data.uid)
@@ -254,24 +281,23 @@ async def request_rejected_handler(callback: CallbackQuery, callback_data: Callb
 
 @router.callback_query(SendSubscriptionCredentialsCallback.filter())
 async def request_credentials_handler(callback: CallbackQuery, callback_data: CallbackData, bot: Bot):
-    with BaseConnectionState(db_name="xclient", use_dict_cursor=True) as conn:
+    async with UnitOfWork(use_dict_cursor=True) as conn:
         subscription_details = await conn.select(queries["select_subscription_server"], callback.from_user.id,
                                                  callback_data.uuid)
     logger.error(f'{subscription_details} | {[callback.from_user.id, callback_data.uuid]}')
     server = ServerContainer(**subscription_details[0])
-    credentials_request = XrayUpdateRequest(user_id=callback.from_user.id, server_ip=server.ip_address, uuid=callback_data.uuid)
-    credentials_response = await credentials_request.make_request_to_server(method="credentials")
-    if credentials_response is None:
-        await bot.send_message(chat_id=callback.from_user.id, text=strings["unexpected_error_message"])
-        logger.error(f"Couldn't reach {callback_data.server_ip}. Check if the server is up")
+    vless_link = await credential_cache.get_link(server.ip_address, callback_data.uuid, callback.from_user.id)
+    if vless_link is None:
+        await send_message_to_user(bot, chat_id=callback.from_user.id, text=strings["unexpected_error_message"])
+        logger.error(f"Couldn't reach {server.ip_address}. Check if the server is up")
         return
-    qr = make_qr_code(credentials_response["message"])
     try:
-        await bot.send_photo(chat_id=callback.from_user.id, caption=strings["requested_qr_received"].format(
-            server_alias=server.alias,
-            server_location=server.location,
-            flag=flag_aliases[server.flag_code]
-        ), photo=BufferedInputFile(file=qr.getbuffer(), filename="vless_link.png"))
+        await qr_codes.send_photo(bot, chat_id=callback.from_user.id, link=vless_link,
+                                  caption=strings["requested_qr_received"].format(
+                                      server_alias=server.alias,
+                                      server_location=server.location,
+                                      flag=flag_aliases[server.flag_code]
+                                  ))
     except aiogram.exceptions.TelegramAPIError as e:
         logger.error(f"Failed to send message to {callback.from_user.id}: {e}")
         await send_message_to_user(bot, chat_id=callback.from_user.id, text=strings["unexpected_error_message"])
@@ -1,8 +1,10 @@
+from collections import OrderedDict
 from functools import wraps
 from aiogram.types import KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from abc import ABC, abstractmethod
 from callbacks import *
+from config import botconf_parser, LazyObject
 from strings import YamlStrings
 import logging
 
@@ -11,18 +13,47 @@ strings = YamlStrings()
 flag_aliases = {"FR": "🇫🇷", "ND": "🇳🇱", "FIN": "🇫🇮"}
 
 
+class MarkupCache:
+    """Bounded LRU of built markups, keyed by the keyboard class and the inputs the markup depends on."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.markups = OrderedDict()
+
+    def get(self, key):
+        markup = self.markups.get(key)
+        if markup is not None:
+            self.markups.move_to_end(key)
+        return markup
+
+    def put(self, key, markup):
+        self.markups[key] = markup
+        while len(self.markups) > self.size:
+            self.markups.popitem(last=False)
+
+
+markup_cache = LazyObject(lambda: MarkupCache(size=int(botconf_parser["BotParameters"]["markup_cache_size"])))
+
+
 def save_markup(method):
     @wraps(method)
     def wrapper(self, *args, **kwargs):
-        if self._markup is not None:
-            # logging.info(f'{self.__class__.__name__} markup exists')
-            return self._markup
-        # logging.info(f'{self.__class__.__name__} markup doesn\'t exist')
-        self._markup = method(self, *args, **kwargs)
-        return self._markup
+        key = self.cache_key()
+        if key is None:
+            return method(self, *args, **kwargs)
+        key = (self.__class__, key)
+        markup = markup_cache.get(key)
+        if markup is None:
+            markup = method(self, *args, **kwargs)
+            markup_cache.put(key, markup)
+        return markup
     return wrapper
 
 
+def page_key(page) -> tuple:
+    return page.number, page.has_previous, page.has_next, page.first_key, page.last_key
+
+
 def months_endings_updater(value):
     if value % 10 == 1:
         return "Месяц"
@@ -33,45 +64,35 @@ def months_endings_updater(value):
 
 
 class BaseKeyboard(ABC):
-    __instance = None
     _builder = None
-    _markup = None
-
-    def __new__(cls, *args, **kwargs):
-        if cls.__instance is None:
-            cls.__instance = super().__new__(cls)
-        return cls.__instance
 
     def __init__(self, **kwargs):
         self.builder = self._builder()
         for kwkey, kwval in kwargs.items():
             setattr(self, kwkey, kwval)
 
-    @staticmethod
-    def pagination_pattern(*, offset: int, total: int, callback, offset_change=5):
-        pages = total // offset_change if total % offset_change == 0 else total // offset_change + 1
-        pages_count = InlineKeyboardButton(text=f"Страница {offset // offset_change + 1}/{pages}",
-                                           callback_data="null")
-        if total <= offset_change:
-            return pages_count,
-        if offset:
-            print(total, offset, total // offset)
+    def cache_key(self):
+        """Everything the markup depends on; None keeps the markup out of the cache."""
+        return ()
 
+    @staticmethod
+    def pagination_pattern(*, page, callback):
+        pages_count = InlineKeyboardButton(text=f"Страница {page.number}", callback_data="null")
         next_action_button = None
         back_button = None
-        forward_condition = not offset or (total // offset > 1 if total != 2 * offset else False)
-        backward_condition = offset > 0
 
-        if forward_condition:
+        if page.has_next:
             next_action_button = InlineKeyboardButton(text="👉 Следующая",
-                                                      callback_data=callback(offset=offset + offset_change,
-                                                                             total=total).pack())
-        if backward_condition:
+                                                      callback_data=callback(cursor=page.last_key, forward=True,
+                                                                             page=page.number + 1).pack())
+        if page.has_previous:
             back_button = InlineKeyboardButton(text="👈 Предыдущая",
-                                               callback_data=callback(offset=offset - offset_change,
-                                                                      total=total).pack())
+                                               callback_data=callback(cursor=page.first_key, forward=False,
+                                                                      page=page.number - 1).pack())
 
         to_create = list(filter(lambda btn: btn is not None, [back_button, next_action_button]))
+        if not to_create:
+            return pages_count,
         if len(to_create) == 2:
             result = to_create[0], pages_count, to_create[1]
         else:
@@ -94,6 +115,7 @@ class BaseInlineKeyboard(BaseKeyboard):
 
 class SomeReplyKeyboard(BaseReplyKeyboard):
 
+    @save_markup
     def markup(self):
         connect_button = KeyboardButton(text="Создать подключение")
         help_button = KeyboardButton(text="Помощь")
@@ -123,6 +145,7 @@ def back_to_menu_button() -> InlineKeyboardButton:
 
 class BackToMainMenuKeyboard(BaseInlineKeyboard):
 
+    @save_markup
     def markup(self):
         self.builder.row(back_to_menu_button())
         return self.builder.as_markup()
@@ -134,6 +157,9 @@ class HelpInlineKeyboard(BaseInlineKeyboard):
         self.neko_link = neko_link
         super().__init__(**kwargs)
 
+    def cache_key(self):
+        return self.neko_link,
+
     @save_markup
     def markup(self):
         neko_link_button = InlineKeyboardButton(text="📱Клиент Nekobox", url=self.neko_link)
@@ -146,39 +172,46 @@ class HelpInlineKeyboard(BaseInlineKeyboard):
 
 class SubscriptionsPaginationKeyboard(BaseInlineKeyboard):
 
-    def __init__(self, *, button_text_iterator, offset, total, offset_change, **kwargs):
-        self.button_text_iterator = button_text_iterator
-        self.offset = offset
-        self.total = total
-        self.offset_change = offset_change
+    def __init__(self, *, button_text_iterator, page, **kwargs):
+        self.button_text_iterator = tuple(button_text_iterator)
+        self.page = page
         super().__init__(**kwargs)
 
+    def cache_key(self):
+        return tuple((uuid, button_text) for _, uuid, button_text in self.button_text_iterator), page_key(self.page)
+
+    @save_markup
     def markup(self):
         for _, uuid, button_text in self.button_text_iterator:
             self.builder.row(InlineKeyboardButton(text=button_text, callback_data=SendSubscriptionCredentialsCallback(uuid=uuid).pack()))
 
-        self.builder.row(*self.pagination_pattern(offset=self.offset, total=self.total, offset_change=self.offset_change,
-                                             callback=NextSubscriptionPage))
+        self.builder.row(*self.pagination_pattern(page=self.page, callback=NextSubscriptionPage))
         self.builder.row(back_to_menu_button())
         return self.builder.as_markup()
 
 
 class ServerChoiceKeyboard(BaseInlineKeyboard):
 
-    def __init__(self, servers, total: int, offset=0,  **kwargs):
-        self.total = total
-        self.offset = offset
-        self.servers = servers
+    def __init__(self, page, unavailable=frozenset(), **kwargs):
+        self.page = page
+        self.unavailable = unavailable
         super().__init__(**kwargs)
 
+    def cache_key(self):
+        servers = tuple((server.id, server.flag_code, server.location, server.alias,
+                         server.ip_address in self.unavailable) for server in self.page.items)
+        return servers, page_key(self.page)
+
+    @save_markup
     def markup(self):
-        for server in self.servers:
-            button = InlineKeyboardButton(text=f'{flag_aliases[server.flag_code]} {server.location} | {server.alias}',
+        for server in self.page.items:
+            status = " | 🔧 недоступен" if server.ip_address in self.unavailable else ""
+            button = InlineKeyboardButton(text=f'{flag_aliases[server.flag_code]} {server.location} | {server.alias}{status}',
                                           callback_data=ChooseParticularServerCallback(
                                               server_id=server.id
                                           ).pack())
             self.builder.row(button)
-        pagination = self.pagination_pattern(offset=self.offset, total=self.total, offset_change=2, callback=NextServerPageCallback)
+        pagination = self.pagination_pattern(page=self.page, callback=NextServerPageCallback)
         self.builder.row(*pagination)
         self.builder.row(back_to_menu_button())
         return self.builder.as_markup()
@@ -191,6 +224,10 @@ class SubscriptionDurationKeyboard(BaseInlineKeyboard):
         self.tariffs = tariffs
         super().__init__(**kwargs)
 
+    def cache_key(self):
+        return self.server_data.server_id, tuple((tariff.id, tariff.duration, tariff.price) for tariff in self.tariffs)
+
+    @save_markup
     def markup(self):
         for tariff in self.tariffs:
             self.builder.row(
@@ -213,6 +250,9 @@ class AcceptOrDeclineNewRequestKeyboard(BaseInlineKeyboard):
         self.server_ip = server_ip
         super().__init__(**kwargs)
 
+    def cache_key(self):
+        return None
+
     def markup(self):
         accept = InlineKeyboardButton(text="✅", callback_data=RequestAcceptedCallback(
             uid=self.uid,
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+from typing import Callable
+import asyncpg
+from config import botconf_parser
+from database import connection_parameters
+
+logger = logging.getLogger(__name__)
+leader_lock_id = 7_310_002
+
+
+class LeaderLease:
+    """Elects the one bot process that runs the scheduled jobs through a Postgres advisory lock.
+
+    The lock is taken on a dedicated connection and held for the life of
+    that session. The leader pings the session every ``renew_interval``
+    seconds and steps down as soon as a ping fails; TCP keepalives make the
+    server drop the session of a dead leader after a longer delay, which
+    releases the lock for whichever follower asks for it next.
+
+    This does not rule out overlap: if the server ends the session itself, a
+    follower can take the lock up to one ``renew_interval`` before the old
+    leader notices, and stepping down doesn't stop a job that is already
+    running. The jobs are written for that: expiry and archiving claim each
+    row with ``DELETE ... RETURNING`` and only notify for the rows they got,
+    and a repeated reachability probe only rewrites the same result.
+    """
+
+    def __init__(self, renew_interval: float, on_elected: Callable, on_deposed: Callable):
+        self.renew_interval = renew_interval
+        self.on_elected = on_elected
+        self.on_deposed = on_deposed
+        self.is_leader = False
+
+    async def connect(self) -> asyncpg.Connection:
+        database_config = botconf_parser["Database"]
+        return await asyncpg.connect(**connection_parameters(), server_settings={
+            "tcp_keepalives_idle": database_config["lease_keepalive_idle"],
+            "tcp_keepalives_interval": database_config["lease_keepalive_interval"],
+            "tcp_keepalives_count": database_config["lease_keepalive_count"],
+            "application_name": "vpn-bot-leader-lease"
+        })
+
+    async def hold(self, connection: asyncpg.Connection):
+        while True:
+            if self.is_leader:
+                await asyncio.wait_for(connection.fetchval("SELECT 1;"), self.renew_interval)
+            elif await asyncio.wait_for(connection.fetchval("SELECT pg_try_advisory_lock($1);", leader_lock_id),
+                                        self.renew_interval):
+                self.is_leader = True
+                logger.info("Elected as the leader, starting the scheduled jobs")
+                self.on_elected()
+            await asyncio.sleep(self.renew_interval)
+
+    async def run(self):
+        while True:
+            connection = None
+            try:
+                connection = await self.connect()
+                await self.hold(connection)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError, asyncpg.InterfaceError) as e:
+                logger.error(f"Leader lease lost: {e}")
+            finally:
+                if self.is_leader:
+                    self.is_leader = False
+                    logger.warning("Stepped down as the leader, stopping the scheduled jobs")
+                    self.on_deposed()
+                if connection is not None and not connection.is_closed():
+                    connection.terminate()
+            await asyncio.sleep(self.renew_interval)
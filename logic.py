@@ -1,55 +1,51 @@
+import asyncio
 import json
-import urllib.request
 import logging
 from functools import wraps, partial
 import ssl
+import time
+from enum import Enum
+import aiohttp
 import aiogram.exceptions
-import qrcode
-import io
 from aiogram import Bot
 from config import botconf_parser
 from bot_instance import bot
+from database import Priority
+from delivery import delivery_queue
 from strings import YamlStrings
 
 
 strings = YamlStrings()
 logger = logging.getLogger(__name__)
 
-def make_qr_code(vless_link):
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(vless_link)
-    qr.make(fit=True)
-    img = qr.make_image(fill='black', back_color='white')
-    img_bytes = io.BytesIO()
-    img.save(img_bytes, format='PNG')
-    img_bytes.seek(0)
-    return img_bytes
-
-
 async def send_message_to_user(bot, chat_id: int, text: str, reply_markup=None):
     try:
         kwargs = {
-            "chat_id": chat_id,
             "text": text
         }
         if reply_markup is not None:
             kwargs["reply_markup"] = reply_markup
-        await bot.send_message(**kwargs)
+        await delivery_queue.submit(bot.send_message, chat_id=chat_id, **kwargs)
     except aiogram.exceptions.TelegramAPIError as e:
         logger.error(f"Failed to send message to {chat_id}: {e}")
 
 
 async def check_if_user_reachable(bot: Bot, chat_id: int):
+    """Returns None when the check itself failed, so callers don't mistake a network error for a blocked chat."""
     try:
-        await bot.send_chat_action(chat_id=chat_id, action='typing')
-    except aiogram.exceptions.TelegramAPIError as e:
+        await delivery_queue.submit(bot.send_chat_action, chat_id=chat_id, action='typing', priority=Priority.BACKGROUND)
+    except (aiogram.exceptions.TelegramForbiddenError, aiogram.exceptions.TelegramNotFound) as e:
         logger.info(f"{chat_id} is not reachable! Cause: {str(e)}")
         return False
+    except aiogram.exceptions.TelegramBadRequest as e:
+        if "chat not found" not in str(e).lower():
+            logger.warning(f"Couldn't check whether {chat_id} is reachable: {e}")
+            return None
+        logger.info(f"{chat_id} is not reachable! Cause: {str(e)}")
+        return False
+    except aiogram.exceptions.TelegramAPIError as e:
+        logger.warning(f"Couldn't check whether {chat_id} is reachable: {e}")
+        return None
     else:
         return True
 
@@ -59,7 +55,9 @@ def handle_network_errors(function):
     async def wrapper(*args, **kwargs):
         try:
             return await function(*args, **kwargs)
-        except urllib.error.URLError as e:
+        except NodeUnavailableError as e:
+            return {"message": str(e), "status": None, "circuit_open": True}
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             return {"message": str(e), "status": None}
         except Exception as e:
             logger.error(f"Unexpected error: {e}")
@@ -73,11 +71,14 @@ def notify_admin(function=None, admin_id:int=None):
 
     async def wrapper(self, method="credentials"):
         response_json = await function(self, method)
+        if response_json.get("circuit_open"):
+            logger.warning(f"Skipped /{method} on {self.server_ip}: {response_json['message']}")
+            return None
         if response_json.get("status", 200) != 200:
-            await bot.send_message(chat_id=admin_id,
-                                   text=f"The response code was not 200 from {self.server_ip}.\n"
-                                        f"Message: {str(response_json['message']).replace('<', '').replace('>', '')}\n"
-                                        f"Method: /{method}")
+            await send_message_to_user(bot, chat_id=admin_id or botconf_parser["BotHost"]["id"],
+                                       text=f"The response code was not 200 from {self.server_ip}.\n"
+                                            f"Message: {str(response_json['message']).replace('<', '').replace('>', '')}\n"
+                                            f"Method: /{method}")
             logger.error(
                 f"The response code was not 200 from {self.server_ip}.\n"
                 f"Message: {str(response_json['message']).replace('<', '').replace('>', '')}\n"
@@ -88,8 +89,126 @@ def notify_admin(function=None, admin_id:int=None):
     return wrapper
 
 
+class NodeUnavailableError(Exception):
+    pass
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+
+class CircuitBreaker:
+    """Stops calling a node after failure_threshold consecutive failures.
+
+    Once reset_timeout has passed, a single probe request is let through; its
+    outcome either closes the circuit again or keeps it open for another
+    reset_timeout.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def available(self) -> bool:
+        if self.state is CircuitState.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        return not (self.state is CircuitState.HALF_OPEN and self.probing)
+
+    def allow(self) -> bool:
+        if not self.available:
+            return False
+        if self.state is not CircuitState.CLOSED:
+            self.state, self.probing = CircuitState.HALF_OPEN, True
+        return True
+
+    def record_success(self):
+        self.state, self.failures, self.probing = CircuitState.CLOSED, 0, False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state is CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state, self.opened_at = CircuitState.OPEN, time.monotonic()
+
+
+class NodeTransport:
+    """Keeps one keep-alive HTTPS connection pool and one circuit breaker per control-server node.
+
+    Connections are reused across requests while they stay open. Every new
+    or re-opened connection (after keepalive_timeout, a node restart or a
+    network error) still does a full TLS handshake: TLS session resumption is
+    out of scope, since asyncio's SSL transport, which aiohttp uses, gives no
+    way to hand a saved session to a new connection. Connection failures,
+    timeouts and 5xx responses count against the node's breaker; while it is
+    open, requests fail immediately with NodeUnavailableError.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self.breakers = {}
+        self.context = ssl._create_unverified_context()
+
+    def session(self, server_ip: str) -> aiohttp.ClientSession:
+        session = self.sessions.get(server_ip)
+        if session is None or session.closed:
+            node_config = botconf_parser["Nodes"]
+            connector = aiohttp.TCPConnector(ssl=self.context,
+                                             limit=int(node_config["connections_per_node"]),
+                                             keepalive_timeout=float(node_config["keepalive_seconds"]))
+            timeout = aiohttp.ClientTimeout(sock_connect=float(node_config["connect_timeout"]),
+                                            sock_read=float(node_config["read_timeout"]))
+            session = self.sessions[server_ip] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return session
+
+    def breaker(self, server_ip: str) -> CircuitBreaker:
+        if server_ip not in self.breakers:
+            self.breakers[server_ip] = CircuitBreaker(int(botconf_parser["Nodes"]["failure_threshold"]),
+                                                      float(botconf_parser["Nodes"]["reset_timeout"]))
+        return self.breakers[server_ip]
+
+    def is_available(self, server_ip: str) -> bool:
+        return self.breaker(server_ip).available
+
+    def unavailable_nodes(self) -> set:
+        return {server_ip for server_ip, breaker in self.breakers.items() if not breaker.available}
+
+    async def post(self, server_ip: str, url: str, data: bytes, headers: dict) -> tuple:
+        breaker = self.breaker(server_ip)
+        if not breaker.allow():
+            raise NodeUnavailableError(f"{server_ip} is unavailable, circuit is {breaker.state.value}")
+        try:
+            async with self.session(server_ip).post(url, data=data, headers=headers) as response:
+                status, body = response.status, await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            breaker.record_failure()
+            raise
+        except BaseException:
+            breaker.probing = False
+            raise
+        if status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return status, body
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+
+node_transport = NodeTransport()
+
+
 class XrayUpdateRequest:
-    url = "https://{server_ip}:4443/{method}"
+    url = "https://{server_ip}:{port}/{method}"
 
     def __init__(self, uuid: str, server_ip: str, user_id: int):
         self.uuid = uuid
@@ -99,28 +218,73 @@ class XrayUpdateRequest:
         self.headers = {
             "Content-Type": "application/json",
             "Token": bot.token,
-            "UserId": user_id
+            "UserId": str(user_id)
         }
         self.data = json.dumps({
             "uuid": uuid
         }).encode('utf-8')
-        self.context = ssl._create_unverified_context()
 
-    @notify_admin(admin_id=botconf_parser["BotHost"]["id"])
+    @notify_admin
     @handle_network_errors
     async def make_request_to_server(self, method="credentials") -> dict:
         assert isinstance(method, str)
-        url = self.url.format(server_ip=self.server_ip, method=method)
-        add_user_req = urllib.request.Request(url, data=self.data, headers=self.headers)
+        url = self.url.format(server_ip=self.server_ip, port=botconf_parser["Nodes"]["port"], method=method)
         logger.info(f"Making request to {url}")
-        with urllib.request.urlopen(add_user_req, context=self.context) as response:
-            status_code = response.getcode()
-            if status_code != 200:
-                logger.error(
-                    f"Couldn't request the /{method}. Code: {status_code}")
-                logger.error(json.loads(response.read().decode(response.info().get_param('charset') or 'utf-8')))
-                return {"status": status_code, "message": response.read().decode(response.info().get_param('charset') or 'utf-8')}
-            return json.loads(response.read().decode(response.info().get_param('charset') or 'utf-8'))
+        status_code, body = await node_transport.post(self.server_ip, url, data=self.data, headers=self.headers)
+        if status_code != 200:
+            logger.error(
+                f"Couldn't request the /{method}. Code: {status_code}")
+            logger.error(body)
+            return {"status": status_code, "message": body}
+        return json.loads(body)
+
+
+class XrayBatchDeleteRequest(XrayUpdateRequest):
+
+    def __init__(self, uuids: list, server_ip: str):
+        super().__init__(uuid=None, server_ip=server_ip, user_id=0)
+        self.uuids = uuids
+        self.data = json.dumps({
+            "uuids": uuids
+        }).encode('utf-8')
+
+
+class CredentialCache:
+    """Keeps every node's Reality settings (SNI, SID, pbk, port) so VLESS links are built without a node call.
+
+    Nodes send their template with every /add and /credentials response. The
+    template carries a version, and the version reported by /stats on every
+    load table refresh drops a template that no longer matches the node.
+    """
+
+    def __init__(self):
+        self.templates = {}
+
+    def store(self, server_ip: str, template: dict):
+        if template is not None:
+            self.templates[server_ip] = template
+
+    def invalidate(self, server_ip: str, version: str):
+        template = self.templates.get(server_ip)
+        if template is not None and template.get("version") != version:
+            del self.templates[server_ip]
+            logger.info(f"Credential template of {server_ip} changed, dropped the cached one")
+
+    def link(self, server_ip: str, uuid: str):
+        template = self.templates.get(server_ip)
+        if template is None:
+            return None
+        return strings["vless_link"].format(uuid=uuid, **template)
 
+    async def get_link(self, server_ip: str, uuid: str, user_id: int):
+        link = self.link(server_ip, uuid)
+        if link is None and node_transport.is_available(server_ip):
+            credentials_request = XrayUpdateRequest(uuid=uuid, server_ip=server_ip, user_id=user_id)
+            credentials_response = await credentials_request.make_request_to_server(method="credentials")
+            if credentials_response is not None:
+                self.store(server_ip, credentials_response.get("template"))
+                link = credentials_response["message"]
+        return link
 
 
+credential_cache = CredentialCache()
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+from argparse import ArgumentParser
+import asyncpg
+from database import connection_parameters
+from strings import YamlQueries
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+migrations_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "migrations")
+migrations_lock_id = 7_310_001
+hot_tables = {"serverrequest", "serversubscriber", "subscriber"}
+
+
+def load_migrations() -> list:
+    migrations = []
+    for filename in sorted(os.listdir(migrations_path)):
+        if not filename.endswith(".sql"):
+            continue
+        version = int(filename.split("_", 1)[0])
+        with open(os.path.join(migrations_path, filename), 'r', encoding='utf-8') as file:
+            migrations.append((version, filename, file.read()))
+    return migrations
+
+
+async def migrate(connection: asyncpg.Connection) -> list:
+    """Applies every migration newer than the recorded schema version, each in its own transaction."""
+    await connection.execute("SELECT pg_advisory_lock($1)", migrations_lock_id)
+    try:
+        await connection.execute("CREATE TABLE IF NOT EXISTS SchemaMigration ("
+                                 "version INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, applied_at TIMESTAMP NOT NULL)")
+        applied = {row["version"] for row in await connection.fetch("SELECT version FROM SchemaMigration")}
+        newly_applied = []
+        for version, name, sql in load_migrations():
+            if version in applied:
+                continue
+            async with connection.transaction():
+                await connection.execute(sql)
+                await connection.execute("INSERT INTO SchemaMigration (version, name, applied_at) "
+                                         "VALUES ($1, $2, current_timestamp)", version, name)
+            logger.info(f"Applied migration {name}")
+            newly_applied.append(name)
+        return newly_applied
+    finally:
+        await connection.execute("SELECT pg_advisory_unlock($1)", migrations_lock_id)
+
+
+def sequential_scans(plan: dict):
+    """Yields relations read in full: Seq Scans and index scans without an index condition."""
+    node_type = plan.get("Node Type")
+    if node_type == "Seq Scan" or (node_type in ("Index Scan", "Index Only Scan") and "Index Cond" not in plan):
+        yield plan["Relation Name"]
+    for subplan in plan.get("Plans", ()):
+        yield from sequential_scans(subplan)
+
+
+async def check_query_plans(connection: asyncpg.Connection) -> dict:
+    """Returns the catalog queries that still read a hot table in full.
+
+    Plans are forced to be generic and sequential scans are disabled, so a
+    full scan in the result means no index can serve the query at all,
+    regardless of how much data the database currently holds.
+    """
+    offenders = {}
+    async with connection.transaction():
+        await connection.execute("SET LOCAL enable_seqscan = off; SET LOCAL plan_cache_mode = force_generic_plan")
+        for name, query in YamlQueries().items():
+            parameters = (await connection.prepare(query)).get_parameters()
+            await connection.execute(f"PREPARE plan_check AS {query}")
+            arguments = f"({', '.join(['NULL'] * len(parameters))})" if parameters else ""
+            plan = json.loads(await connection.fetchval(f"EXPLAIN (FORMAT JSON) EXECUTE plan_check{arguments}"))
+            await connection.execute("DEALLOCATE plan_check")
+            scanned = hot_tables.intersection(sequential_scans(plan[0]["Plan"]))
+            if scanned:
+                offenders[name] = sorted(scanned)
+    return offenders
+
+
+async def main():
+    parser = ArgumentParser()
+    parser.add_argument("--check-plans", action="store_true",
+                        help="Fail if a query from queries.yaml reads a hot table in full")
+    args = parser.parse_args()
+    connection = await asyncpg.connect(**connection_parameters())
+    try:
+        await migrate(connection)
+        if args.check_plans:
+            offenders = await check_query_plans(connection)
+            for name, tables in offenders.items():
+                logger.error(f"{name} falls back to a full scan of {', '.join(tables)}")
+            if offenders:
+                sys.exit(1)
+    finally:
+        await connection.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,10 +1,4 @@
-DROP TABLE IF EXISTS ServerSubscriber;
-DROP TABLE IF EXISTS ServerRequest;
-DROP TABLE IF EXISTS Subscriber;
-DROP TABLE IF EXISTS Server;
-DROP TABLE IF EXISTS Tariff;
-
-CREATE TABLE Server (
+CREATE TABLE IF NOT EXISTS Server (
     id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
     alias VARCHAR(40) NOT NULL,
     ip_address VARCHAR(16) NOT NULL,
@@ -12,20 +6,20 @@ CREATE TABLE Server (
     flag_code VARCHAR(3) NOT NULL
 );
 
-CREATE TABLE Subscriber (
+CREATE TABLE IF NOT EXISTS Subscriber (
     telegram_id BIGINT PRIMARY KEY,
     telegram_username VARCHAR(50),
     join_date TIMESTAMP NOT NULL
 );
 
-CREATE TABLE Tariff (
+CREATE TABLE IF NOT EXISTS Tariff (
     id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
     title VARCHAR(40) UNIQUE NOT NULL,
     price INTEGER NOT NULL,
     duration INTEGER NOT NULL
 );
 
-CREATE TABLE ServerSubscriber (
+CREATE TABLE IF NOT EXISTS ServerSubscriber (
     server_id BIGINT REFERENCES Server(id),
     subscriber_id BIGINT REFERENCES Subscriber(telegram_id) NOT NULL,
     tariff_id INTEGER REFERENCES Tariff(id) NOT NULL,
@@ -34,7 +28,7 @@ CREATE TABLE ServerSubscriber (
     PRIMARY KEY (server_id, subscriber_id)
 );
 
-CREATE TABLE ServerRequest (
+CREATE TABLE IF NOT EXISTS ServerRequest (
     uid VARCHAR(36) PRIMARY KEY,
     telegram_requester_id BIGINT NOT NULL,
     telegram_requester_username VARCHAR(100),
@@ -44,9 +38,11 @@ CREATE TABLE ServerRequest (
 );
 
 
-INSERT INTO Server (ip_address, alias, location, flag_code) VALUES ('194.120.116.246', 'Tulip', 'Netherlands', 'ND');
-INSERT INTO Server (ip_address, alias, location, flag_code) VALUES ('188.130.207.163', 'Croissant', 'France', 'FR');
-INSERT INTO Server (ip_address, alias, location, flag_code) VALUES ('188.120.207.153', 'Aurora', 'Finland', 'FIN');
-INSERT INTO Tariff (title, price, duration) VALUES ('Bronze', 169, 1);
-INSERT INTO Tariff (title, price, duration) VALUES ('Silver', 449, 3);
-INSERT INTO Tariff (title, price, duration) VALUES ('Gold', 799, 6);
\ No newline at end of file
+INSERT INTO Server (ip_address, alias, location, flag_code)
+SELECT * FROM (VALUES ('194.120.116.246', 'Tulip', 'Netherlands', 'ND'),
+                      ('188.130.207.163', 'Croissant', 'France', 'FR'),
+                      ('188.120.207.153', 'Aurora', 'Finland', 'FIN')) AS seed (ip_address, alias, location, flag_code)
+WHERE NOT EXISTS (SELECT 1 FROM Server);
+INSERT INTO Tariff (title, price, duration) VALUES ('Bronze', 169, 1) ON CONFLICT (title) DO NOTHING;
+INSERT INTO Tariff (title, price, duration) VALUES ('Silver', 449, 3) ON CONFLICT (title) DO NOTHING;
+INSERT INTO Tariff (title, price, duration) VALUES ('Gold', 799, 6) ON CONFLICT (title) DO NOTHING;
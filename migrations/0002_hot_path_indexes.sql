@@ -0,0 +1,8 @@
+-- look_for_expired_subscriptions
+CREATE INDEX IF NOT EXISTS serversubscriber_valid_until_idx ON ServerSubscriber (subscription_valid_until);
+-- select_active_subscriptions / select_active_subscriptions_before (keyset on server_id per subscriber)
+CREATE INDEX IF NOT EXISTS serversubscriber_subscriber_server_idx ON ServerSubscriber (subscriber_id, server_id);
+-- select_server_choice / select_tariffs_for_server
+CREATE INDEX IF NOT EXISTS serverrequest_requester_server_idx ON ServerRequest (telegram_requester_id, requested_server);
+-- delete_old_server_requests
+CREATE INDEX IF NOT EXISTS serverrequest_request_date_idx ON ServerRequest (request_date);
@@ -0,0 +1,16 @@
+CREATE TABLE IF NOT EXISTS ServerRequestArchive (
+    uid VARCHAR(36) PRIMARY KEY,
+    telegram_requester_id BIGINT NOT NULL,
+    telegram_requester_username VARCHAR(100),
+    requested_server BIGINT NOT NULL,
+    requested_tariff BIGINT NOT NULL,
+    request_date TIMESTAMP NOT NULL,
+    archived_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS PurgeWatermark (
+    table_name VARCHAR(40) PRIMARY KEY,
+    watermark TIMESTAMP NOT NULL
+);
+
+INSERT INTO PurgeWatermark (table_name, watermark) VALUES ('ServerRequest', '1970-01-01') ON CONFLICT DO NOTHING;
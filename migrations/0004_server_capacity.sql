@@ -0,0 +1 @@
+ALTER TABLE Server ADD COLUMN IF NOT EXISTS capacity INTEGER NOT NULL DEFAULT 200;
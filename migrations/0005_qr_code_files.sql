@@ -0,0 +1,5 @@
+CREATE TABLE IF NOT EXISTS QrCodeFile (
+    link_hash VARCHAR(64) PRIMARY KEY,
+    file_id VARCHAR(255) NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
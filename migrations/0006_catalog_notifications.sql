@@ -0,0 +1,14 @@
+CREATE OR REPLACE FUNCTION notify_catalog_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('catalog_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS server_catalog_changed ON Server;
+CREATE TRIGGER server_catalog_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Server
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_changed();
+
+DROP TRIGGER IF EXISTS tariff_catalog_changed ON Tariff;
+CREATE TRIGGER tariff_catalog_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON Tariff
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_catalog_changed();
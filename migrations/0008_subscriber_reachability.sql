@@ -0,0 +1,2 @@
+ALTER TABLE Subscriber ADD COLUMN IF NOT EXISTS reachable BOOLEAN NOT NULL DEFAULT TRUE;
+ALTER TABLE Subscriber ADD COLUMN IF NOT EXISTS reachability_checked_at TIMESTAMP;
@@ -0,0 +1,3 @@
+-- look_for_expired_subscriptions (keyset on subscription_valid_until, uuid)
+CREATE INDEX IF NOT EXISTS serversubscriber_valid_until_uuid_idx ON ServerSubscriber (subscription_valid_until, uuid);
+DROP INDEX IF EXISTS serversubscriber_valid_until_idx;
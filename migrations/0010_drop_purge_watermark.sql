@@ -0,0 +1,3 @@
+-- archive_old_server_requests no longer keeps a watermark: rows it skipped while they were locked
+-- must stay eligible, and every chunk is resumable on its own.
+DROP TABLE IF EXISTS PurgeWatermark;
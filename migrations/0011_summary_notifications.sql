@@ -0,0 +1,23 @@
+-- Every insert or delete of a user's requests or subscriptions sends the user id on summaries_changed,
+-- so each worker can drop its cached summary (summaries.py).
+CREATE OR REPLACE FUNCTION notify_summary_changed() RETURNS trigger AS $$
+DECLARE
+    changed_row record;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed_row := OLD;
+    ELSE
+        changed_row := NEW;
+    END IF;
+    PERFORM pg_notify('summaries_changed', to_jsonb(changed_row) ->> TG_ARGV[0]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS serverrequest_summary_changed ON ServerRequest;
+CREATE TRIGGER serverrequest_summary_changed AFTER INSERT OR DELETE ON ServerRequest
+    FOR EACH ROW EXECUTE FUNCTION notify_summary_changed('telegram_requester_id');
+
+DROP TRIGGER IF EXISTS serversubscriber_summary_changed ON ServerSubscriber;
+CREATE TRIGGER serversubscriber_summary_changed AFTER INSERT OR DELETE ON ServerSubscriber
+    FOR EACH ROW EXECUTE FUNCTION notify_summary_changed('subscriber_id');
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import logging
+import aiohttp
+from config import botconf_parser
+from catalog import catalog
+from containers import ServerContainer, NodeLoad, Page
+from database import UnitOfWork, Priority
+from logic import XrayUpdateRequest, NodeUnavailableError, node_transport, credential_cache
+from strings import YamlQueries
+
+queries = YamlQueries()
+logger = logging.getLogger(__name__)
+
+
+class LoadTable:
+    """Keeps the number of clients on every node in memory and ranks the servers by remaining capacity.
+
+    A refresh counts the active subscribers per server in the database and asks
+    every available node how many clients its xray configuration holds; the
+    larger of the two is the node's load. Between refreshes the subscriber
+    counts are adjusted by the handlers and the expiry job. The ranking that the
+    server choice keyboard pages through is only rebuilt on refresh, so the
+    order doesn't shift while a user is flipping pages. Besides the periodic
+    refresh, a change to the Server table (``catalog_changed``) refreshes
+    the table at once.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.ranking = ()
+        self.lock = asyncio.Lock()
+        self.changed = asyncio.Event()
+
+    async def fetch_node_stats(self, server_ip: str):
+        if not node_transport.is_available(server_ip):
+            return None
+        request = XrayUpdateRequest(uuid=None, server_ip=server_ip, user_id=0)
+        url = request.url.format(server_ip=server_ip, port=botconf_parser["Nodes"]["port"], method="stats")
+        try:
+            status, body = await node_transport.post(server_ip, url, data=request.data, headers=request.headers)
+        except (NodeUnavailableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Couldn't get the stats of {server_ip}: {e}")
+            return None
+        if status != 200:
+            logger.warning(f"Couldn't get the stats of {server_ip}. Code: {status}")
+            return None
+        return json.loads(body)["message"]
+
+    async def refresh(self):
+        async with self.lock:
+            async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+                rows = await conn.select(queries["select_server_load"])
+            servers = [(ServerContainer(*row[:-1]), row[-1]) for row in rows]
+            node_stats = await asyncio.gather(*(self.fetch_node_stats(server.ip_address) for server, _ in servers))
+            self.nodes = {}
+            for (server, subscribers), stats in zip(servers, node_stats):
+                self.nodes[server.id] = NodeLoad(server=server, subscribers=subscribers,
+                                                 reported_clients=stats["clients"] if stats else None)
+                if stats and "template_version" in stats:
+                    credential_cache.invalidate(server.ip_address, stats["template_version"])
+            self.rank()
+        logger.info(f"Load table refreshed for {len(self.nodes)} servers")
+
+    def rank(self):
+        available = [node for node in self.nodes.values() if node.remaining > 0]
+        available.sort(key=lambda node: (-node.remaining, node.server.id))
+        self.ranking = tuple(node.server for node in available)
+
+    async def ensure_loaded(self):
+        if not self.nodes:
+            await self.refresh()
+
+    def add_subscription(self, server_id: int):
+        if server_id in self.nodes:
+            self.nodes[server_id].subscribers += 1
+
+    def remove_subscriptions(self, server_id: int, count: int):
+        if server_id in self.nodes:
+            node = self.nodes[server_id]
+            node.subscribers = max(node.subscribers - count, 0)
+
+    def page(self, size: int, cursor: int = None, forward: bool = True, number: int = 1) -> Page:
+        positions = [server.id for server in self.ranking]
+        if cursor not in positions:
+            cursor, forward, number = None, True, 1
+        if cursor is None:
+            rows = self.ranking[:size + 1]
+        elif forward:
+            start = positions.index(cursor) + 1
+            rows = self.ranking[start:start + size + 1]
+        else:
+            end = positions.index(cursor)
+            rows = self.ranking[max(end - size - 1, 0):end]
+        return Page.from_rows(list(rows), size=size, number=number, forward=forward, key=lambda server: server.id)
+
+    def describe(self) -> str:
+        lines = []
+        for node in sorted(self.nodes.values(), key=lambda node: node.server.id):
+            reported = "?" if node.reported_clients is None else node.reported_clients
+            lines.append(f"{node.server.alias} ({node.server.ip_address}): {node.load}/{node.server.capacity}, "
+                         f"подписок {node.subscribers}, клиентов на узле {reported}, осталось {node.remaining}")
+        return "\n".join(lines) or "Нет данных о загрузке серверов."
+
+    async def run(self):
+        interval = float(botconf_parser["Nodes"]["load_refresh_seconds"])
+        while True:
+            self.changed.clear()
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Couldn't refresh the load table: {e}")
+            try:
+                await asyncio.wait_for(self.changed.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+load_table = LoadTable()
+catalog.on_change(load_table.changed.set)
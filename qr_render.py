@@ -0,0 +1,22 @@
+import io
+import qrcode
+
+
+def make_qr_code(vless_link) -> bytes:
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(vless_link)
+    qr.make(fit=True)
+    img = qr.make_image(fill='black', back_color='white')
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format='PNG')
+    return img_bytes.getvalue()
+
+
+def warm_up():
+    """Runs once in every worker process so PIL is imported before the first real request."""
+    make_qr_code("warm-up")
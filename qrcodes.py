@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import BufferedInputFile, Message
+from config import botconf_parser, LazyObject
+from database import UnitOfWork
+from delivery import delivery_queue
+from qr_render import make_qr_code, warm_up
+from strings import YamlQueries
+
+queries = YamlQueries()
+logger = logging.getLogger(__name__)
+
+
+class QrRenderer:
+    """Renders QR codes in a pool of worker processes so PIL never runs on the event loop.
+
+    The pool is started (and every worker warmed up) from ``start`` before the
+    bot opens any connection, so the forked workers inherit no live sockets.
+    At most ``workers + queue_size`` renders are submitted at a time; further
+    callers wait for a slot without blocking the loop.
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.workers = workers
+        self.slots = asyncio.Semaphore(workers + queue_size)
+        self.executor = None
+
+    def start(self):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up)
+            for future in [self.executor.submit(int) for _ in range(self.workers)]:
+                future.result()
+
+    async def render(self, link: str) -> bytes:
+        self.start()
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, make_qr_code, link)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+
+class QrCodeCache:
+    """Delivers VLESS links as QR photos, rendering and uploading each link at most once.
+
+    Rendered PNGs are kept in a bounded LRU. Once Telegram has stored a photo,
+    its file_id is remembered in memory and in QrCodeFile, so later requests
+    for the same link (from this or any other worker) resend the file_id
+    without rendering or uploading anything.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.renders = OrderedDict()
+        self.file_ids = OrderedDict()
+
+    @staticmethod
+    def link_hash(link: str) -> str:
+        return hashlib.sha256(link.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def remember(cache: OrderedDict, key: str, value, size: int):
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > size:
+            cache.popitem(last=False)
+
+    async def render(self, link: str) -> bytes:
+        key = self.link_hash(link)
+        if key in self.renders:
+            self.renders.move_to_end(key)
+            return self.renders[key]
+        image = await qr_renderer.render(link)
+        self.remember(self.renders, key, image, self.size)
+        return image
+
+    async def file_id(self, link: str):
+        key = self.link_hash(link)
+        if key in self.file_ids:
+            self.file_ids.move_to_end(key)
+            return self.file_ids[key]
+        async with UnitOfWork() as conn:
+            rows = await conn.select(queries["select_qr_file_id"], key)
+        if rows:
+            self.remember(self.file_ids, key, rows[0][0], self.size)
+            return rows[0][0]
+        return None
+
+    async def store_file_id(self, link: str, file_id: str):
+        key = self.link_hash(link)
+        self.remember(self.file_ids, key, file_id, self.size)
+        self.renders.pop(key, None)
+        try:
+            async with UnitOfWork() as conn:
+                await conn.execute(queries["upsert_qr_file_id"], key, file_id)
+        except Exception as e:
+            logger.error(f"Couldn't save the file_id of a QR code: {e}")
+
+    async def send_photo(self, bot: Bot, chat_id: int, link: str, caption: str) -> Message:
+        file_id = await self.file_id(link)
+        if file_id is not None:
+            try:
+                return await delivery_queue.submit(bot.send_photo, chat_id=chat_id, photo=file_id, caption=caption)
+            except TelegramBadRequest as e:
+                logger.warning(f"Cached QR code file_id was rejected, uploading it again: {e}")
+                self.file_ids.pop(self.link_hash(link), None)
+        photo = BufferedInputFile(file=await self.render(link), filename="vless_link.png")
+        message = await delivery_queue.submit(bot.send_photo, chat_id=chat_id, photo=photo, caption=caption)
+        await self.store_file_id(link, message.photo[-1].file_id)
+        return message
+
+
+qr_renderer = LazyObject(lambda: QrRenderer(workers=int(botconf_parser["BotParameters"]["qr_workers"]),
+                                            queue_size=int(botconf_parser["BotParameters"]["qr_queue_size"])))
+qr_codes = LazyObject(lambda: QrCodeCache(size=int(botconf_parser["BotParameters"]["qr_cache_size"])))
@@ -1,38 +1,167 @@
+import asyncio
+import datetime
 import logging
+import time
+from collections import defaultdict
 from aiogram import Bot
-from containers import ServerSubscriber
-from database import BaseConnectionState
-from logic import XrayUpdateRequest, send_message_to_user
+from containers import ServerSubscriber, NodeReport
+from database import UnitOfWork, Priority
+from delivery import delivery_queue
+from logic import XrayBatchDeleteRequest, check_if_user_reachable
+from placement import load_table
+from summaries import user_summaries
 from strings import YamlStrings, YamlQueries
+from config import botconf_parser
 
 strings = YamlStrings()
 queries = YamlQueries()
 logger = logging.getLogger(__name__)
 
 
-async def check_subscription_expiration_date(bot: Bot):
+async def deprovision_chunk(bot: Bot, server_ip: str, chunk: list, report: NodeReport, semaphore: asyncio.Semaphore):
+    async with semaphore:
+        if report.node_down:
+            report.failed += len(chunk)
+            return
+        uuids = [subscriber.uuid for subscriber in chunk]
+        delete_request_response = await XrayBatchDeleteRequest(uuids=uuids, server_ip=server_ip).make_request_to_server(
+            method="delete")
+        if delete_request_response is None:
+            report.node_down = True
+            report.failed += len(chunk)
+            return
+        async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+            deleted = {row["uuid"] for row in await conn.execute(queries["delete_expired_users"], uuids,
+                                                                 returning=True)}
+        # Rows another leader already deleted are left to the notices that leader sends.
+        chunk = [subscriber for subscriber in chunk if subscriber.uuid in deleted]
+        if not chunk:
+            return
+        report.deprovisioned += len(chunk)
+        load_table.remove_subscriptions(chunk[0].server_id, len(chunk))
+        for subscriber in chunk:
+            user_summaries.subscription_removed(subscriber.subscriber_id, subscriber.server_id)
+
+    notices = [(subscriber.subscriber_id, strings["subscription_expired"].format(
+        location=subscriber.server_location,
+        alias=subscriber.server_alias,
+        subscription_id=subscriber.uuid
+    )) for subscriber in chunk]
+    try:
+        await delivery_queue.enqueue_notices(notices)
+    except Exception as e:
+        logger.error(f"Couldn't queue {len(notices)} expiry notices: {e}")
+
+
+async def deprovision_node(bot: Bot, server_ip: str, subscribers: list, report: NodeReport, semaphore: asyncio.Semaphore):
+    chunk_size = int(botconf_parser["BotParameters"]["expiry_node_chunk_size"])
+    started = time.monotonic()
+    await asyncio.gather(*(deprovision_chunk(bot, server_ip, subscribers[index:index + chunk_size], report, semaphore)
+                           for index in range(0, len(subscribers), chunk_size)))
+    report.elapsed += time.monotonic() - started
+
+
+async def check_subscription_expiration_date(bot: Bot, now: datetime.datetime = None) -> dict:
+    """Deprovisions subscriptions that expired before ``now`` node by node, all nodes at once.
+
+    ``now`` is the bot host's clock, which also wrote subscription_valid_until,
+    so the database's clock and timezone don't decide what is due.
+
+    Expired rows are read one keyset batch at a time, each in its own short
+    transaction, so no connection is held while the nodes are called. A node
+    that fails a request is skipped for the rest of the run; its rows stay in
+    ServerSubscriber and are picked up again by the next run.
+    """
     logger.info("check_subscription_expiration_date has been triggered")
-    with BaseConnectionState(db_name="xclient", password="roottoor") as conn:
-        expired_subscribers = tuple(map(lambda cont: ServerSubscriber(*cont),
-                                        await conn.select(queries["look_for_expired_subscriptions"])))
-        for subscriber in expired_subscribers:
-            vless_delete_request = XrayUpdateRequest(uuid=subscriber.uuid,
-                                                     server_ip=subscriber.server_ip_address, user_id=subscriber.subscriber_id)
-            delete_request_response = await vless_delete_request.make_request_to_server(method="delete")
-            logger.error(delete_request_response)
-            if delete_request_response is None:
-                return
-            await conn.execute(queries["delete_expired_user"], subscriber.uuid, autocommit=True)
-            await send_message_to_user(bot, chat_id=subscriber.subscriber_id,
-                                       text=strings["subscription_expired"].format(
-                                           location=subscriber.server_location,
-                                           alias=subscriber.server_alias,
-                                           subscription_id=subscriber.uuid
-                                        )
-                                       )
-
-
-async def delete_old_server_requests():
-    logger.info("delete_old_server_requests has been triggered")
-    with BaseConnectionState(db_name="xclient", password="roottoor") as conn:
-        await conn.execute(queries["delete_old_server_requests"], autocommit=True)
+    batch_size = int(botconf_parser["BotParameters"]["expiry_batch_size"])
+    node_concurrency = int(botconf_parser["BotParameters"]["expiry_node_concurrency"])
+    reports = defaultdict(NodeReport)
+    semaphores = defaultdict(lambda: asyncio.Semaphore(node_concurrency))
+    now = now or datetime.datetime.now()
+    cursor = (datetime.datetime.min, "")
+    while True:
+        async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+            batch = await conn.select(queries["look_for_expired_subscriptions"], now, *cursor, batch_size)
+        if not batch:
+            break
+        subscribers = [ServerSubscriber(*row) for row in batch]
+        cursor = (subscribers[-1].subscription_valid_until, subscribers[-1].uuid)
+        by_node = defaultdict(list)
+        for subscriber in subscribers:
+            by_node[subscriber.server_ip_address].append(subscriber)
+        await asyncio.gather(*(deprovision_node(bot, server_ip, subscribers, reports[server_ip], semaphores[server_ip])
+                               for server_ip, subscribers in by_node.items()))
+        if len(batch) < batch_size:
+            break
+
+    for server_ip, report in reports.items():
+        log = logger.error if report.failed else logger.info
+        log(f"Expiry on {server_ip}: {report.deprovisioned} deprovisioned in {report.elapsed:.1f}s "
+            f"({report.throughput:.1f}/s), {report.failed} carried over to the next run")
+    return dict(reports)
+
+
+async def archive_old_server_requests() -> int:
+    """Moves expired ServerRequest rows into ServerRequestArchive in short, paced transactions.
+
+    Each chunk moves the oldest expired rows and commits, so an interrupted
+    run simply resumes with the next one. Rows locked by a handler at the
+    time are skipped and stay eligible for a later chunk or run.
+    """
+    logger.info("archive_old_server_requests has been triggered")
+    chunk_size = int(botconf_parser["BotParameters"]["purge_chunk_size"])
+    pause = float(botconf_parser["BotParameters"]["purge_pause_seconds"])
+    archived = 0
+    while True:
+        async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+            moved = await conn.execute(queries["archive_old_server_requests"], chunk_size, returning=True)
+        for row in moved:
+            user_summaries.request_removed(row["telegram_requester_id"], row["requested_server"])
+        archived += len(moved)
+        if len(moved) < chunk_size:
+            break
+        await asyncio.sleep(pause)
+    logger.info(f"Archived {archived} server requests")
+    return archived
+
+
+async def sweep_subscriber_reachability(bot: Bot) -> int:
+    """Checks which subscribers still accept messages from the bot, one keyset batch at a time.
+
+    Rows checked within reachability_recheck_hours only refresh the in-memory
+    set of unreachable chats; the rest are probed concurrently through the
+    delivery queue, which paces them, and written back with one update per
+    batch. A probe that failed for another reason leaves the row untouched.
+    """
+    logger.info("sweep_subscriber_reachability has been triggered")
+    batch_size = int(botconf_parser["BotParameters"]["reachability_batch_size"])
+    recheck_after = datetime.timedelta(hours=float(botconf_parser["BotParameters"]["reachability_recheck_hours"]))
+    fresh_since = datetime.datetime.now() - recheck_after
+    cursor, checked, unreachable = 0, 0, 0
+    while True:
+        async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+            subscribers = await conn.select(queries["select_subscribers_for_sweep"], cursor, batch_size)
+        if not subscribers:
+            break
+        cursor = subscribers[-1]["telegram_id"]
+        stale = []
+        for subscriber in subscribers:
+            checked_at = subscriber["reachability_checked_at"]
+            if checked_at is not None and checked_at > fresh_since:
+                delivery_queue.set_reachable(subscriber["telegram_id"], subscriber["reachable"])
+            else:
+                stale.append(subscriber["telegram_id"])
+        results = await asyncio.gather(*(check_if_user_reachable(bot, chat_id) for chat_id in stale))
+        probed = [(chat_id, reachable) for chat_id, reachable in zip(stale, results) if reachable is not None]
+        if probed:
+            chat_ids, flags = map(list, zip(*probed))
+            async with UnitOfWork(priority=Priority.BACKGROUND) as conn:
+                await conn.execute(queries["update_subscriber_reachability"], chat_ids, flags)
+            for chat_id, reachable in probed:
+                delivery_queue.set_reachable(chat_id, reachable)
+        checked += len(probed)
+        unreachable += sum(1 for _, reachable in probed if not reachable)
+        if len(subscribers) < batch_size:
+            break
+    logger.info(f"Checked {checked} subscribers, {unreachable} of them are unreachable")
+    return checked
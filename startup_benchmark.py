@@ -0,0 +1,97 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser, SUPPRESS
+
+project_path = os.path.dirname(os.path.realpath(__file__))
+bot_modules = ("handlers", "scheduled_tasks", "expiry", "leadership", "placement", "catalog", "delivery", "qrcodes",
+               "webhook")
+
+
+def record_io(events: list):
+    """Collects the project files (other than code) opened and the sockets connected from now on."""
+    def hook(event, arguments):
+        if event == "open" and isinstance(arguments[0], str):
+            path = os.path.realpath(arguments[0])
+            if path.startswith(project_path) and not path.endswith((".py", ".pyc")):
+                events.append(f"open {os.path.relpath(path, project_path)}")
+        elif event == "socket.connect":
+            events.append(f"connect {arguments[1]}")
+    sys.addaudithook(hook)
+
+
+def cold_start(with_database: bool) -> dict:
+    """Runs in a fresh interpreter: imports the bot, then builds everything a worker needs before serving."""
+    import asyncio
+    io_on_import = []
+    record_io(io_on_import)
+    started = time.perf_counter()
+    for module in bot_modules:
+        __import__(module)
+    imported = time.perf_counter()
+    io_on_import = list(io_on_import)
+
+    from bot_instance import application, parse_args
+    from delivery import delivery_queue
+    from handlers import router
+    from keyboards import markup_cache
+    from qrcodes import qr_codes
+    from strings import YamlQueries, YamlStrings
+    from summaries import user_summaries
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    application.configure(parse_args(["--token", "123456789:benchmark-token-benchmark-token-000"]))
+    application.dispatcher.include_router(router)
+    bot, scheduler = application.bot, application.scheduler
+    YamlQueries.load()
+    YamlStrings.load()
+    for singleton in (delivery_queue, markup_cache, qr_codes, user_summaries):
+        singleton._resolve()
+    built = time.perf_counter()
+
+    if with_database:
+        from database import BaseConnectionState
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(BaseConnectionState.get_pool())
+        loop.run_until_complete(BaseConnectionState.close_pool())
+    connected = time.perf_counter()
+    return {"import": imported - started, "build": built - imported, "database": connected - built,
+            "io_on_import": io_on_import}
+
+
+def main():
+    parser = ArgumentParser(description="Measures the cold start of a bot worker in fresh interpreters")
+    parser.add_argument("--runs", type=int, default=10, help="Number of interpreters to start")
+    parser.add_argument("--with-database", action="store_true", help="Also open and close the connection pool")
+    parser.add_argument("--child", action="store_true", help=SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(cold_start(args.with_database)))
+        return
+
+    command = [sys.executable, os.path.realpath(__file__), "--child"] + (["--with-database"] if args.with_database else [])
+    results, totals = [], []
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        child = subprocess.run(command, cwd=project_path, capture_output=True, text=True)
+        totals.append(time.perf_counter() - started)
+        if child.returncode != 0:
+            sys.exit(child.stderr)
+        results.append(json.loads(child.stdout.splitlines()[-1]))
+
+    phases = ["import", "build"] + (["database"] if args.with_database else [])
+    for phase in phases:
+        timings = [result[phase] * 1000 for result in results]
+        print(f"{phase:>12}: median {statistics.median(timings):8.1f} ms, min {min(timings):8.1f} ms")
+    print(f"{'process':>12}: median {statistics.median(totals) * 1000:8.1f} ms, min {min(totals) * 1000:8.1f} ms")
+    io_on_import = sorted({event for result in results for event in result["io_on_import"]})
+    if io_on_import:
+        print("I/O done on import:", *io_on_import, sep="\n  ")
+        sys.exit(1)
+    print("No I/O done on import")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,29 @@
 import os
+from collections.abc import Mapping
 import yaml
 
 
-class BaseYaml:
+class BaseYaml(Mapping):
+    """Read-only view of a YAML file that is parsed on the first lookup and shared by every instance."""
     strings_path = None
     content = None
 
-    def __new__(cls, *args, **kwargs) -> dict:
+    @classmethod
+    def load(cls) -> dict:
         if cls.content is None:
             with open(cls.strings_path, 'r', encoding='utf-8') as file:
                 cls.content = yaml.safe_load(file)
         return cls.content
 
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
 
 class YamlQueries(BaseYaml):
     strings_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "queries.yaml")
@@ -0,0 +1,96 @@
+import logging
+import time
+from collections import OrderedDict
+from catalog import catalog
+from config import botconf_parser, LazyObject
+from containers import UserSummary
+from database import UnitOfWork
+from strings import YamlQueries
+
+queries = YamlQueries()
+logger = logging.getLogger(__name__)
+
+
+class UserSummaryCache:
+    """Keeps what the menus need to know about a user: pending requests and subscribed servers.
+
+    A summary is loaded with one query on first use and then kept up to date
+    by the code that inserts or deletes the user's requests and subscriptions.
+    Changes made by other processes (the leader's expiry and archive jobs,
+    handlers on other workers) arrive as ``summaries_changed`` notifications
+    on the catalog's connection and drop the user's summary; everything is
+    dropped whenever that connection (re)starts. Entries also expire after
+    ``ttl`` seconds, in case notifications are down, and the least recently
+    used ones are evicted beyond ``size``.
+    """
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.summaries = OrderedDict()
+        self.loading = {}
+
+    async def load(self, user_id: int) -> UserSummary:
+        self.loading[user_id] = False
+        try:
+            async with UnitOfWork() as conn:
+                row = (await conn.select(queries["select_user_summary"], user_id))[0]
+            summary = UserSummary(request_count=len(row["pending_servers"]),
+                                  pending_servers=set(row["pending_servers"]),
+                                  subscribed_servers=set(row["subscribed_servers"]),
+                                  loaded_at=time.monotonic())
+        finally:
+            changed_meanwhile = self.loading.pop(user_id, False)
+        if not changed_meanwhile:
+            self.summaries[user_id] = summary
+            while len(self.summaries) > self.size:
+                self.summaries.popitem(last=False)
+        return summary
+
+    async def get(self, user_id: int) -> UserSummary:
+        summary = self.summaries.get(user_id)
+        if summary is None or time.monotonic() - summary.loaded_at > self.ttl:
+            return await self.load(user_id)
+        self.summaries.move_to_end(user_id)
+        return summary
+
+    def cached(self, user_id: int):
+        if user_id in self.loading:
+            self.loading[user_id] = True
+        return self.summaries.get(user_id)
+
+    def forget(self, user_id: int):
+        if user_id in self.loading:
+            self.loading[user_id] = True
+        self.summaries.pop(user_id, None)
+
+    def clear(self):
+        for user_id in self.loading:
+            self.loading[user_id] = True
+        self.summaries.clear()
+
+    def request_added(self, user_id: int, server_id: int):
+        if summary := self.cached(user_id):
+            summary.request_count += 1
+            summary.pending_servers.add(server_id)
+
+    def request_removed(self, user_id: int, server_id: int):
+        if summary := self.cached(user_id):
+            summary.request_count = max(summary.request_count - 1, 0)
+            summary.pending_servers.discard(server_id)
+
+    def subscription_added(self, user_id: int, server_id: int):
+        if summary := self.cached(user_id):
+            summary.subscribed_servers.add(server_id)
+
+    def subscription_removed(self, user_id: int, server_id: int):
+        if summary := self.cached(user_id):
+            summary.subscribed_servers.discard(server_id)
+
+
+user_summaries = LazyObject(lambda: UserSummaryCache(size=int(botconf_parser["BotParameters"]["summary_cache_size"]),
+                                                     ttl=float(botconf_parser["BotParameters"]["summary_ttl_seconds"])))
+
+catalog.on_notification("summaries_changed",
+                        lambda connection, pid, channel, payload: user_summaries.forget(int(payload)))
+catalog.on_change(lambda: user_summaries.clear())
@@ -0,0 +1,48 @@
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+
+class FakeBotApi:
+    """Answers Bot API calls locally, records every call and hands out a Bot that talks to it."""
+
+    token = "123456789:fake-bot-api-token"
+
+    def __init__(self):
+        self.calls = []
+        self.runner = None
+        self.port = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls.append((method, dict(await request.post())))
+        if method == "sendMessage":
+            return web.json_response({"ok": True, "result": {"message_id": 1, "date": 0, "text": "",
+                                                             "chat": {"id": 1, "type": "private"}}})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {"id": 123456789, "is_bot": True, "first_name": "Fake",
+                                                             "username": "fake_bot"}})
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": []})
+        return web.json_response({"ok": True, "result": True})
+
+    def methods(self) -> list:
+        return [method for method, _ in self.calls]
+
+    async def start(self) -> "FakeBotApi":
+        application = web.Application()
+        application.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(application)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    def bot(self) -> Bot:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{self.port}"))
+        return Bot(self.token, session=session)
+
+    async def stop(self):
+        await self.runner.cleanup()
@@ -0,0 +1,99 @@
+import asyncio
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+from aiohttp import web
+
+
+def self_signed_certificate(directory: str) -> tuple:
+    certificate, private_key = os.path.join(directory, "node.crt"), os.path.join(directory, "node.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "ec", "-pkeyopt", "ec_paramgen_curve:prime256v1", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+                    "-keyout", private_key, "-out", certificate], check=True, capture_output=True)
+    return certificate, private_key
+
+
+openssl_available = shutil.which("openssl") is not None
+
+
+class StandInNode:
+    """A control server stand-in: the same routes and JSON replies over TLS, served from its own thread and loop.
+
+    Every request records the client's address, so the number of distinct
+    ports is the number of TCP connections the bot opened. ``delay`` holds
+    each reply back without blocking the node, and ``status`` makes every
+    route fail with that code.
+    """
+
+    template = {"host": "127.0.0.1", "port": 443, "SNI": "example.com", "alpn": "h2", "pbk": "key", "SID": "ab",
+                "version": "v1"}
+
+    def __init__(self, delay: float = 0.0, status: int = 200):
+        self.delay = delay
+        self.status = status
+        self.peers = []
+        self.clients = set()
+        self.port = None
+        self.loop = None
+        self.runner = None
+        self.thread = None
+        self.directory = tempfile.TemporaryDirectory()
+
+    @property
+    def connections(self) -> int:
+        return len(set(self.peers))
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.peers.append(request.transport.get_extra_info("peername"))
+        body = await request.json()
+        await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return web.json_response({"message": "Stand-in failure"}, status=self.status)
+        method = request.match_info["method"]
+        if method == "add":
+            self.clients.add(body["uuid"])
+            return web.json_response({"message": "User added successfully", "link": None, "template": self.template})
+        if method == "delete":
+            self.clients.difference_update(body["uuids"])
+            return web.json_response({"message": f"{len(body['uuids'])} users deleted successfully"})
+        if method == "stats":
+            return web.json_response({"message": {"clients": len(self.clients),
+                                                  "template_version": self.template["version"]}})
+        return web.json_response({"message": f"vless://{body['uuid']}@{self.template['host']}", "template": self.template})
+
+    async def serve(self, ready: threading.Event):
+        certificate, private_key = self_signed_certificate(self.directory.name)
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certificate, private_key)
+        application = web.Application()
+        application.router.add_post("/{method}", self.handle)
+        self.runner = web.AppRunner(application)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0, ssl_context=context)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        ready.set()
+
+    def start(self) -> "StandInNode":
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.create_task(self.serve(ready))
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run, name="stand-in-node", daemon=True)
+        self.thread.start()
+        if not ready.wait(30):
+            raise RuntimeError("The stand-in node didn't start")
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result(10)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+        self.loop.close()
+        self.directory.cleanup()
@@ -0,0 +1,85 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+from config import botconf_parser
+from logic import NodeTransport, XrayUpdateRequest
+from stand_in_node import StandInNode, openssl_available
+
+
+@unittest.skipUnless(openssl_available, "openssl is needed to make the stand-in node's certificate")
+class NodeTransportTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.node = StandInNode(delay=0.05).start()
+        self.port = botconf_parser["Nodes"]["port"]
+        botconf_parser["Nodes"]["port"] = str(self.node.port)
+        self.transport = NodeTransport()
+        self.bot = mock.Mock(token="123456:stand-in")
+        self.delivery_queue = mock.Mock(submit=mock.AsyncMock())
+        self.patches = [mock.patch("logic.node_transport", self.transport), mock.patch("logic.bot", self.bot),
+                        mock.patch("logic.delivery_queue", self.delivery_queue)]
+        for patch in self.patches:
+            patch.start()
+
+    async def asyncTearDown(self):
+        await self.transport.close()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        botconf_parser["Nodes"]["port"] = self.port
+        self.node.stop()
+
+    def request(self, uuid: str) -> XrayUpdateRequest:
+        return XrayUpdateRequest(uuid=uuid, server_ip="127.0.0.1", user_id=1)
+
+    async def test_sequential_requests_share_one_connection(self):
+        for number in range(10):
+            response = await self.request(f"uuid-{number}").make_request_to_server(method="add")
+            self.assertEqual(response["template"], StandInNode.template)
+        self.assertEqual(len(self.node.peers), 10)
+        self.assertEqual(self.node.connections, 1)
+
+    async def test_concurrent_requests_stay_within_the_pool(self):
+        await asyncio.gather(*(self.request(f"uuid-{number}").make_request_to_server(method="add")
+                               for number in range(16)))
+        self.assertEqual(len(self.node.clients), 16)
+        self.assertLessEqual(self.node.connections, int(botconf_parser["Nodes"]["connections_per_node"]))
+
+    async def test_slow_node_does_not_block_the_loop(self):
+        self.node.delay = 0.5
+        gaps, last = [], time.monotonic()
+
+        async def tick():
+            nonlocal last
+            while True:
+                await asyncio.sleep(0.01)
+                gaps.append(time.monotonic() - last)
+                last = time.monotonic()
+
+        ticker = asyncio.create_task(tick())
+        started = time.monotonic()
+        await asyncio.gather(*(self.request(f"uuid-{number}").make_request_to_server(method="add")
+                               for number in range(4)))
+        elapsed = time.monotonic() - started
+        ticker.cancel()
+        self.assertLess(elapsed, 1.5)
+        self.assertGreater(len(gaps), 20)
+        self.assertLess(max(gaps[1:]), 0.2)
+
+    async def test_failures_notify_the_admin_and_open_the_circuit(self):
+        self.node.status = 500
+        threshold = int(botconf_parser["Nodes"]["failure_threshold"])
+        for _ in range(threshold):
+            self.assertIsNone(await self.request("uuid").make_request_to_server(method="add"))
+        self.assertEqual(self.delivery_queue.submit.await_count, threshold)
+        self.assertFalse(self.transport.is_available("127.0.0.1"))
+        requests_before = len(self.node.peers)
+        self.assertIsNone(await self.request("uuid").make_request_to_server(method="add"))
+        self.assertEqual(len(self.node.peers), requests_before)
+        self.assertEqual(self.delivery_queue.submit.await_count, threshold)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,53 @@
+import os
+import unittest
+import asyncpg
+import migrate
+from database import connection_parameters
+
+
+class QueryPlansTest(unittest.IsolatedAsyncioTestCase):
+    """Applies the migrations to a scratch database next to the configured one and checks every catalog query."""
+
+    async def asyncSetUp(self):
+        self.parameters = connection_parameters()
+        self.database = f"plan_check_{os.getpid()}"
+        try:
+            self.admin = await asyncpg.connect(**self.parameters, timeout=5)
+        except (OSError, asyncpg.PostgresError) as e:
+            self.skipTest(f"No Postgres reachable at [Database]: {e}")
+        try:
+            await self.admin.execute(f"CREATE DATABASE {self.database}")
+        except asyncpg.PostgresError as e:
+            await self.admin.close()
+            self.skipTest(f"Can't create a scratch database: {e}")
+        self.connection = await asyncpg.connect(**{**self.parameters, "database": self.database})
+
+    async def asyncTearDown(self):
+        await self.connection.close()
+        await self.admin.execute(f"DROP DATABASE IF EXISTS {self.database} WITH (FORCE)")
+        await self.admin.close()
+
+    async def seed(self):
+        await self.connection.execute("""
+            INSERT INTO Server (ip_address, alias, location, flag_code)
+            SELECT '10.0.' || n / 256 || '.' || n % 256, 'Node ' || n, 'Test', 'TST' FROM generate_series(1, 20) n;
+            INSERT INTO Subscriber (telegram_id, telegram_username, join_date)
+            SELECT n, 'user' || n, now() FROM generate_series(1, 5000) n;
+            INSERT INTO ServerRequest (uid, telegram_requester_id, telegram_requester_username, requested_server,
+                                       requested_tariff, request_date)
+            SELECT md5(n::text), n, 'user' || n, 1 + n % 3, 1, now() - n * interval '1 minute'
+            FROM generate_series(1, 5000) n;
+            INSERT INTO ServerSubscriber (server_id, subscriber_id, tariff_id, uuid, subscription_valid_until)
+            SELECT 1 + n % 3, n, 1, md5('subscription' || n), now() + n * interval '1 hour'
+            FROM generate_series(1, 5000) n;
+            ANALYZE;
+        """)
+
+    async def test_no_query_reads_a_hot_table_in_full(self):
+        await migrate.migrate(self.connection)
+        await self.seed()
+        self.assertEqual(await migrate.check_query_plans(self.connection), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import asyncio
+import socket
+import unittest
+import aiohttp
+from aiogram import Dispatcher, Router
+from aiogram.filters import Command
+from aiogram.types import Message
+from config import botconf_parser
+from fake_bot_api import FakeBotApi
+from webhook import WebhookServer, register_webhook, start_polling
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def start_update(update_id: int) -> dict:
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": 0, "chat": {"id": 1, "type": "private"},
+                        "from": {"id": 1, "is_bot": False, "first_name": "User"}, "text": "/start"}}
+
+
+class WebhookTest(unittest.IsolatedAsyncioTestCase):
+    secret_token = "webhook-test-secret"
+
+    async def asyncSetUp(self):
+        self.webhook_config = dict(botconf_parser["Webhook"])
+        botconf_parser["Webhook"].update(host="127.0.0.1", port=str(free_port()), certificate="", private_key="",
+                                         secret_token=self.secret_token, drain_timeout="5")
+        self.api = await FakeBotApi().start()
+        self.bot = self.api.bot()
+        self.received = []
+        self.router = Router()
+
+        @self.router.message(Command("start"))
+        async def start(message: Message):
+            self.received.append(message.message_id)
+            await message.answer("Hello")
+
+        dispatcher = Dispatcher()
+        dispatcher.include_router(self.router)
+        self.server = WebhookServer(dispatcher, self.bot, secret_token=self.secret_token, workers=2, queue_size=8)
+        await self.server.start()
+        self.url = f"http://127.0.0.1:{botconf_parser['Webhook']['port']}{botconf_parser['Webhook']['path']}"
+        self.client = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.server.stop()
+        await self.api.stop()
+        botconf_parser["Webhook"].update(self.webhook_config)
+
+    async def post(self, body, secret_token=secret_token) -> int:
+        headers = {WebhookServer.secret_header: secret_token} if secret_token is not None else {}
+        async with self.client.post(self.url, data=body, headers=headers) as response:
+            return response.status
+
+    async def test_register_webhook_sends_the_secret_and_used_updates(self):
+        await register_webhook(self.bot, self.router)
+        method, fields = self.api.calls[-1]
+        self.assertEqual(method, "setWebhook")
+        self.assertEqual(fields["secret_token"], self.secret_token)
+        self.assertEqual(fields["allowed_updates"], '["message"]')
+
+    async def test_valid_update_is_dispatched(self):
+        self.assertEqual(await self.post(aiohttp.JsonPayload(start_update(7))), 200)
+        await asyncio.wait_for(self.server.queue.join(), 5)
+        self.assertEqual(self.received, [7])
+        self.assertEqual(self.api.methods(), ["sendMessage"])
+
+    async def test_wrong_secret_is_rejected(self):
+        self.assertEqual(await self.post(aiohttp.JsonPayload(start_update(8)), secret_token="wrong"), 401)
+        self.assertEqual(await self.post(aiohttp.JsonPayload(start_update(9)), secret_token=None), 401)
+        await asyncio.wait_for(self.server.queue.join(), 5)
+        self.assertEqual(self.received, [])
+        self.assertEqual(self.api.calls, [])
+
+    async def test_malformed_update_is_rejected(self):
+        self.assertEqual(await self.post(b"not json"), 400)
+        self.assertEqual(await self.post(aiohttp.JsonPayload({"message": "no update_id"})), 400)
+        await asyncio.wait_for(self.server.queue.join(), 5)
+        self.assertEqual(self.received, [])
+
+    async def test_polling_deletes_a_leftover_webhook_first(self):
+        dispatcher = Dispatcher()
+        dispatcher.include_router(Router())
+        polling = asyncio.create_task(start_polling(dispatcher, self.bot, handle_signals=False, close_bot_session=False))
+        for _ in range(500):
+            if "getUpdates" in self.api.methods():
+                break
+            await asyncio.sleep(0.01)
+        await dispatcher.stop_polling()
+        await asyncio.wait_for(polling, 5)
+        self.assertEqual(self.api.methods()[0], "deleteWebhook")
+
+
+if __name__ == "__main__":
+    unittest.main()
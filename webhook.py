@@ -0,0 +1,123 @@
+import asyncio
+import hmac
+import logging
+import os
+import ssl
+from aiogram import Bot, Dispatcher, Router
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Update, FSInputFile
+from aiohttp import web
+from config import botconf_parser
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """Receives updates pushed by Telegram instead of polling for them.
+
+    Each request is checked against the secret token given to setWebhook,
+    parsed and put on a bounded queue; a fixed number of workers feed the
+    queue to the dispatcher. When the queue is full the request waits, which
+    pushes back on Telegram (it keeps at most ``max_connections`` requests in
+    flight) rather than piling up tasks. Since the server keeps no state of
+    its own, several instances can share one webhook URL behind a load
+    balancer.
+    """
+
+    secret_header = "X-Telegram-Bot-Api-Secret-Token"
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, workers: int, queue_size: int):
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.secret_token = secret_token
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.tasks = []
+        self.runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(self.secret_header, ""), self.secret_token):
+            logger.warning(f"Rejected a webhook request from {request.remote}: wrong secret token")
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError as e:
+            logger.warning(f"Rejected a malformed update: {e}")
+            return web.Response(status=400)
+        await self.queue.put(update)
+        return web.Response()
+
+    async def worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dispatcher.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Update {update.update_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        webhook_config = botconf_parser["Webhook"]
+        application = web.Application()
+        application.router.add_post(webhook_config["path"], self.handle)
+        self.runner = web.AppRunner(application)
+        await self.runner.setup()
+        context = None
+        if webhook_config.get("certificate"):
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(webhook_config["certificate"], webhook_config["private_key"])
+        await web.TCPSite(self.runner, webhook_config["host"], int(webhook_config["port"]), ssl_context=context,
+                          reuse_port=True).start()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        logger.info(f"Listening for updates on {webhook_config['host']}:{webhook_config['port']}{webhook_config['path']}")
+
+    async def stop(self):
+        """Stops accepting updates and gives the ones already acknowledged to Telegram time to finish."""
+        if self.runner is not None:
+            await self.runner.cleanup()
+        try:
+            await asyncio.wait_for(self.queue.join(), float(botconf_parser["Webhook"]["drain_timeout"]))
+        except asyncio.TimeoutError:
+            logger.error(f"{self.queue.qsize()} updates were dropped on shutdown")
+        for task in self.tasks:
+            task.cancel()
+        await self.bot.session.close()
+
+
+def webhook_secret() -> str:
+    secret_token = os.getenv("webhook_secret", botconf_parser["Webhook"]["secret_token"])
+    if not secret_token:
+        raise ValueError("Webhook mode needs a secret_token in [Webhook] or the webhook_secret variable")
+    return secret_token
+
+
+async def register_webhook(bot: Bot, router: Router):
+    """Points Telegram at [Webhook] url. Called once per start from the parent process, not by every worker,
+    since Telegram rate-limits setWebhook."""
+    webhook_config = botconf_parser["Webhook"]
+    certificate = FSInputFile(webhook_config["certificate"]) if webhook_config.get("certificate") else None
+    while True:
+        try:
+            await bot.set_webhook(url=webhook_config["url"], secret_token=webhook_secret(), certificate=certificate,
+                                  max_connections=int(webhook_config["max_connections"]),
+                                  allowed_updates=router.resolve_used_update_types())
+            return
+        except TelegramRetryAfter as e:
+            logger.warning(f"setWebhook is rate-limited, retrying in {e.retry_after}s")
+            await asyncio.sleep(e.retry_after)
+
+
+def create_webhook_server(dispatcher: Dispatcher, bot: Bot) -> WebhookServer:
+    webhook_config = botconf_parser["Webhook"]
+    return WebhookServer(dispatcher, bot,
+                         secret_token=webhook_secret(),
+                         workers=int(webhook_config["workers"]),
+                         queue_size=int(webhook_config["queue_size"]))
+
+
+async def start_polling(dispatcher: Dispatcher, bot: Bot, **kwargs):
+    """Polls for updates. A webhook left behind by a --webhook run makes getUpdates fail with a Conflict,
+    and start_polling doesn't remove it, so it is deleted first."""
+    await bot.delete_webhook()
+    await dispatcher.start_polling(bot, **kwargs)